@@ -35,11 +35,7 @@ from cogs.utils import utils
 
 FIRST_READY = True
 
-bot = utils.Bot(command_prefix=when_mentioned_or("egg ", "Egg "), intents=Intents.all())
-bot.hook_db("data.db")
 
-
-@bot.check
 async def guild_only(ctx: commands.Context):
     if ctx.author.id == bot.owner_id:
         return True
@@ -50,7 +46,6 @@ async def guild_only(ctx: commands.Context):
     return True
 
 
-@bot.event
 async def on_ready():
     """Fired each time bot's connection to Discord is opened and ready."""
     global FIRST_READY
@@ -83,6 +78,16 @@ async def on_ready():
 
     print("Bot is ready.\n")
 
-bot.load_extension("jishaku")
-bot.run(os.getenv("EGG_TOKEN"))
-bot.loop.create_task(bot.web.runner.cleanup())
+
+# render workers started through a forkserver import this file as __mp_main__,
+# they must not start a bot of their own
+if __name__ == "__main__":
+    bot = utils.Bot(command_prefix=when_mentioned_or("egg ", "Egg "), intents=Intents.all())
+    bot.hook_db("data.db")
+
+    bot.add_check(guild_only)
+    bot.event(on_ready)
+
+    bot.load_extension("jishaku")
+    bot.run(os.getenv("EGG_TOKEN"))
+    bot.loop.create_task(bot.web.runner.cleanup())
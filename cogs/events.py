@@ -26,8 +26,9 @@ SOFTWARE.
 import asyncio
 import re
 import traceback
+from collections import Counter, deque
 from datetime import datetime
-from typing import Type, Union
+from typing import Deque, NamedTuple, Type, Union
 
 import discord
 from discord.ext import commands, tasks
@@ -36,24 +37,177 @@ from discord.ext.commands import Cog, Context
 from .utils import utils
 
 EGG_COLOR = 0xF6DECF
+COUNTING_CHANNEL_ID = 662063429879595009
+MOD_LOG_CHANNEL_ID = 662438467204153354
+# Messages previewed in a bulk delete summary
+BULK_DELETE_PREVIEW = 10
+MESSAGE_STORE_FLUSH_INTERVAL = 5
+# Accepted counts kept in memory, so deleting the latest one can roll back to the one before
+COUNTING_HISTORY = 10
+COUNTING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counting (
+    channel_id INTEGER PRIMARY KEY,
+    number INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL
+);
+"""
+
+
+class Count(NamedTuple):
+    """An accepted message in the counting channel."""
+    number: int
+    author_id: int
+    message_id: int
+
+
+def truncate_field(value: str) -> str:
+    """Shortens a value to fit in an embed field."""
+    return value if len(value) < 1024 else f"{value[:1020]}..."
+
+
+def describe_content(content: str, attachments: int, embeds: int = 0) -> str:
+    """Formats a deleted message's content for the mod log."""
+    contents = []
+
+    if content:
+        contents.append(truncate_field(content))
+    if attachments:
+        if attachments == 1:
+            contents.append("[Attachment]")
+        else:
+            contents.append(f"[{attachments} attachments]")
+    if embeds:
+        if content and any(i in content.lower() for i in ("http://", "https://")):
+            pass
+        elif embeds == 1:
+            contents.append("[Embed]")
+        else:
+            contents.append(f"[{embeds} embeds]")
+
+    return "\n\n".join(contents)
 
 
 class Events(Cog):
     """A cog containing the bot's event listeners."""
     def __init__(self, bot: utils.Bot):
         self.bot = bot
-        self.previous_number = None
-
-        self.refresh_previous_number.start()
 
-    async def fetch_previous_number(self):
+        self.counts: Deque[Count] = deque(maxlen=COUNTING_HISTORY)
+        self.counting_ready = asyncio.Event()
+
+        self.mod_log = utils.EmbedDispatcher(bot, MOD_LOG_CHANNEL_ID)
+        self.message_store = utils.MessageStore(bot.db)
+
+        self.bot.loop.create_task(self.load_counting())
+        self.bot.loop.create_task(self.message_store.setup())
+
+        self.flush_message_store.start()  # pylint: disable=no-member
+        self.prune_message_store.start()  # pylint: disable=no-member
+
+        router = self.bot.router
+        router.subscribe(
+            "message", self.store_message,
+            guilds=[utils.CEAPA_COOL_ID], authors=[utils.AUTHOR_USER]
+        )
+        router.subscribe("message", self.check_count, channels=[COUNTING_CHANNEL_ID])
+        router.subscribe("message", self.react_gg)
+        router.subscribe("raw_reaction_add", self.strip_count_reaction,
+                         channels=[COUNTING_CHANNEL_ID])
+
+    def cog_unload(self):
+        self.bot.router.unsubscribe(self)
+        self.flush_message_store.cancel()  # pylint: disable=no-member
+        self.prune_message_store.cancel()  # pylint: disable=no-member
+        self.mod_log.close()
+        self.bot.loop.create_task(self.cog_flush())
+
+    async def cog_flush(self):
+        """Writes buffered messages and sends the mod log entries that are still queued."""
+        await self.message_store.flush()
+        await self.mod_log.flush()
+
+    @tasks.loop(seconds=MESSAGE_STORE_FLUSH_INTERVAL)
+    async def flush_message_store(self):
+        try:
+            await self.message_store.flush()
+        except Exception:  # pylint: disable=broad-except
+            # the batch was put back and gets retried next time
+            traceback.print_exc()
+
+    @tasks.loop(hours=1)
+    async def prune_message_store(self):
+        try:
+            await self.message_store.prune()
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+
+    async def load_counting(self):
+        """Seeds the counting state from the channel's latest messages,
+           falling back to the saved state if the history can't be read.
+        """
         await self.bot.wait_until_ready()
-        previous_message = (await self.bot.get_channel(662063429879595009).history(limit=5).flatten())[0]
-        self.previous_number = int(previous_message.content), previous_message.author.id
 
-    @tasks.loop(seconds=30)
-    async def refresh_previous_number(self):
-        await self.fetch_previous_number()
+        # check_count waits for this, so it's set even if loading fails halfway
+        try:
+            await self.bot.db.executescript(COUNTING_SCHEMA)
+
+            self.counts.clear()
+
+            try:
+                channel = self.bot.get_channel(COUNTING_CHANNEL_ID)
+                messages = await channel.history(limit=COUNTING_HISTORY).flatten()
+            except (AttributeError, discord.HTTPException):
+                traceback.print_exc()
+                messages = []
+
+            for message in reversed(messages):
+                if message.content.isdigit():
+                    self.counts.append(Count(int(message.content), message.author.id, message.id))
+
+            if self.counts:
+                await self.save_count()
+            elif (row := await self.bot.db.fetchone(
+                "SELECT number, author_id, message_id FROM counting WHERE channel_id = ?",
+                COUNTING_CHANNEL_ID
+            )):
+                self.counts.append(Count(*row))
+        finally:
+            self.counting_ready.set()
+
+    async def save_count(self):
+        """Saves the latest accepted count."""
+        if not self.counts:
+            await self.bot.db.execute(
+                "DELETE FROM counting WHERE channel_id = ?", COUNTING_CHANNEL_ID
+            )
+            return
+
+        await self.bot.db.execute(
+            "INSERT OR REPLACE INTO counting VALUES (?, ?, ?, ?)",
+            COUNTING_CHANNEL_ID, *self.counts[-1]
+        )
+
+    async def forget_count(self, message_id: int):
+        """Rolls the counting state back if an accepted count was deleted."""
+        if not any(count.message_id == message_id for count in self.counts):
+            return
+
+        latest = self.counts[-1].message_id == message_id
+        self.counts = deque(
+            (count for count in self.counts if count.message_id != message_id),
+            maxlen=COUNTING_HISTORY
+        )
+
+        if not latest:
+            return
+
+        if self.counts:
+            await self.save_count()
+        else:
+            # every remembered count is gone, read the channel again
+            self.counting_ready.clear()
+            await self.load_counting()
 
     @Cog.listener()
     async def on_command_error(self, ctx: Context, error: Type[commands.CommandError]):
@@ -64,57 +218,54 @@ class Events(Cog):
         await ctx.message.add_reaction("<:oof:663527838812602369>")
         return await utils.display_error(ctx, error)
 
-    @Cog.listener()
-    async def on_message(self, message: discord.Message):
-        """Fired each time a message is sent."""
-        channel = message.channel
-
-        previous_number, previous_author = self.previous_number
-
-        if channel.id == 662063429879595009:
-            contents = [message.activity, message.application, message.attachments,
-                        message.embeds, not message.content.isdigit()]
-            if message.author.id == previous_author or any(i for i in contents):
-                return await message.delete()
-            elif int(message.content) != previous_number + 1:
-                return await message.delete()
-
-            self.previous_number = previous_number + 1, message.author.id
-
+    async def store_message(self, message: discord.Message):
+        """Keeps a copy of every member message for the delete and edit logs."""
+        self.message_store.add(
+            message.id, message.channel.id, message.author.id,
+            message.content, len(message.attachments)
+        )
+
+    async def check_count(self, message: discord.Message):
+        """Deletes messages in the counting channel that don't continue the count."""
+        await self.counting_ready.wait()
+        previous = self.counts[-1] if self.counts else None
+
+        contents = [message.activity, message.application, message.attachments,
+                    message.embeds, not message.content.isdigit()]
+        if any(i for i in contents) or previous and message.author.id == previous.author_id:
+            return await message.delete()
+        elif previous and int(message.content) != previous.number + 1:
+            return await message.delete()
+
+        self.counts.append(Count(int(message.content), message.author.id, message.id))
+        await self.save_count()
+
+    async def react_gg(self, message: discord.Message):
         if message.content.lower() == "gg":
             await message.add_reaction("\N{NEGATIVE SQUARED LATIN CAPITAL LETTER B}\ufe0f")
 
     @Cog.listener()
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
         """Fired when a message is deleted."""
+        if payload.channel_id == COUNTING_CHANNEL_ID:
+            await self.forget_count(payload.message_id)
+
         if payload.guild_id != 527932145273143306:
             return
 
         if payload.cached_message:
             message = payload.cached_message
-            content = message.content
 
             embed = discord.Embed(color=EGG_COLOR, timestamp=datetime.utcnow())
             embed.set_author(name="A message was deleted.", icon_url=message.author.display_avatar.url)
 
-            contents = []
+            content = describe_content(
+                message.content, len(message.attachments), len(message.embeds)
+            )
 
+            # e.g. a sticker, Discord rejects empty field values
             if content:
-                contents.append(content if len(content) < 1024 else f"{content[:1020]}...")
-            if message.attachments:
-                if len(message.attachments) == 1:
-                    contents.append("[Attachment]")
-                else:
-                    contents.append(f"[{len(message.attachments)} attachments]")
-            if message.embeds:
-                if content and any(i in message.content.lower() for i in ("http://", "https://")):
-                    pass
-                elif len(message.embeds) == 1:
-                    contents.append("[Embed]")
-                else:
-                    contents.append(f"[{len(message.embeds)} embeds]")
-
-            embed.add_field(name="Content", value="\n\n".join(contents), inline=False)
+                embed.add_field(name="Content", value=content, inline=False)
             embed.add_field(name="Channel", value=message.channel.mention, inline=False)
 
             embed.add_field(
@@ -123,6 +274,26 @@ class Events(Cog):
                 inline=False
             )
 
+        elif (stored := await self.message_store.get(payload.message_id)):
+            channel = self.bot.get_channel(payload.channel_id)
+            author = self.bot.get_user(stored.author_id)
+
+            embed = discord.Embed(color=EGG_COLOR, timestamp=datetime.utcnow())
+            embed.set_author(
+                name="A message was deleted.",
+                icon_url=(author or self.bot.user).display_avatar.url
+            )
+
+            if (content := describe_content(stored.content, stored.attachments)):
+                embed.add_field(name="Content", value=content, inline=False)
+            embed.add_field(name="Channel", value=channel.mention, inline=False)
+
+            embed.add_field(
+                name="Author",
+                value=f"<@{stored.author_id}> ({author})" if author else f"<@{stored.author_id}>",
+                inline=False
+            )
+
         else:
             channel = self.bot.get_channel(payload.channel_id)
 
@@ -131,33 +302,91 @@ class Events(Cog):
 
             embed.add_field(name="Channel", value=channel.mention)
 
-        await self.bot.get_channel(662438467204153354).send(embed=embed)
+        self.mod_log.put(embed)
+
+    @Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        """Fired when messages are deleted in bulk, e.g. by a purge."""
+        if payload.channel_id == COUNTING_CHANNEL_ID:
+            for message_id in payload.message_ids:
+                await self.forget_count(message_id)
+
+        if payload.guild_id != 527932145273143306:
+            return
+
+        channel = self.bot.get_channel(payload.channel_id)
+        cached = sorted(payload.cached_messages, key=lambda message: message.id)
+
+        embed = discord.Embed(color=EGG_COLOR, timestamp=datetime.utcnow())
+        embed.set_author(
+            name=f"{len(payload.message_ids)} messages were deleted.",
+            icon_url=self.bot.user.display_avatar.url
+        )
+        embed.add_field(name="Channel", value=channel.mention, inline=False)
+
+        if cached:
+            authors = Counter(message.author for message in cached).most_common(10)
+            embed.add_field(
+                name="Authors",
+                value="\n".join(f"{author.mention}: {count}" for author, count in authors),
+                inline=False
+            )
+
+            lines = []
+            for message in cached[-BULK_DELETE_PREVIEW:]:
+                content = message.content or "[No text]"
+                lines.append(f"**{message.author}:** {content[:150]}")
+
+            embed.description = "\n".join(lines)[:4000]
+
+        self.mod_log.put(embed)
 
     @Cog.listener()
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
         """Fired when a message is edited."""
         if not payload.cached_message:
-            guild = self.bot.get_guild(527932145273143306)
-            member = guild.get_member(int(payload.data["author"]["id"]))
+            # payload.data is the raw gateway payload, ids in it are strings, and embed
+            # unfurls and other partial edits leave out the author and content
+            if payload.guild_id != utils.CEAPA_COOL_ID:
+                return
 
-            channel_id = payload.data["channel_id"]
-            message_id = payload.data["id"]
+            if not (author := payload.data.get("author")):
+                return
+
+            guild = self.bot.get_guild(payload.guild_id)
+            if not (member := guild.get_member(int(author["id"]))) or member.bot:
+                return
+
+            channel_id = payload.channel_id
+            message_id = payload.message_id
             jump_url = f"https://discordapp.com/channels/{guild.id}/{channel_id}/{message_id}"
 
-            if payload.data.get("guild_id") != 527932145273143306 or member.bot:
+            if channel_id == COUNTING_CHANNEL_ID:
+                channel = self.bot.get_channel(channel_id)
+                return await channel.get_partial_message(message_id).delete()
+
+            if not (content := payload.data.get("content")):
                 return
 
-            if channel_id == 662063429879595009:
-                return await (await self.bot.get_channel(channel_id).fetch_message(message_id)).delete()
+            stored = await self.message_store.get(message_id)
+
+            if stored and stored.content == content:
+                return
+
+            self.message_store.add(
+                message_id, channel_id, member.id, content, len(payload.data.get("attachments", ()))
+            )
 
             embed = discord.Embed(color=EGG_COLOR, timestamp=datetime.utcnow())
             embed.set_author(name="A message was edited.", icon_url=member.display_avatar.url)
 
-            embed.add_field(name="After", value=payload.data["content"], inline=False)
+            if stored and stored.content:
+                embed.add_field(name="Before", value=truncate_field(stored.content), inline=False)
+            embed.add_field(name="After", value=truncate_field(content), inline=False)
 
             embed.add_field(
                 name="Channel",
-                value=self.bot.get_channel(payload.channel_id).mention,
+                value=self.bot.get_channel(channel_id).mention,
                 inline=False
             )
             embed.add_field(name="Author", value=f"{member.mention} ({member})", inline=False)
@@ -172,17 +401,24 @@ class Events(Cog):
             if not message.guild or message.guild.id != 527932145273143306:
                 return
 
-            if message.channel.id == 662063429879595009:
+            if message.channel.id == COUNTING_CHANNEL_ID:
                 await message.delete()
 
             if not payload.data.get("content") or message.content == payload.data["content"]:
                 return
 
+            self.message_store.add(
+                message.id, message.channel.id, message.author.id,
+                payload.data["content"], len(message.attachments)
+            )
+
             embed = discord.Embed(color=EGG_COLOR, timestamp=datetime.utcnow())
             embed.set_author(name="A message was edited.", icon_url=message.author.display_avatar.url)
 
-            embed.add_field(name="Before", value=message.content, inline=False)
-            embed.add_field(name="After", value=payload.data["content"], inline=False)
+            embed.add_field(name="Before", value=truncate_field(message.content), inline=False)
+            embed.add_field(
+                name="After", value=truncate_field(payload.data["content"]), inline=False
+            )
             embed.add_field(
                 name="Author",
                 value=f"{message.author.mention} ({message.author})",
@@ -190,14 +426,13 @@ class Events(Cog):
             )
 
         embed.description = f"[Jump to message]({jump_url})"
-        await self.bot.get_channel(662438467204153354).send(embed=embed)
+        self.mod_log.put(embed)
 
-    @Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        if payload.channel_id == 662063429879595009:
-            channel = self.bot.get_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            await message.remove_reaction(payload.emoji, payload.member)
+    async def strip_count_reaction(self, payload: discord.RawReactionActionEvent):
+        """Removes reactions in the counting channel."""
+        self.bot.reaction_remover.remove(
+            payload.channel_id, payload.message_id, payload.emoji, payload.user_id, strip_all=True
+        )
 
 
 def setup(bot: utils.Bot):
@@ -21,50 +21,127 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import asyncio
+import traceback
 from datetime import datetime
-from typing import Union
+from typing import Dict, Optional, Tuple, Union
 
 import discord
 from discord import (Invite, Member, Message, RawMessageUpdateEvent,
                      RawReactionActionEvent, User, VoiceState, abc)
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import Cog, Context
 
 from cogs.utils import utils
 
 EGG_COLOR = 0xF6DECF
 
+LAST_SEEN_FLUSH_INTERVAL = 5
+LAST_SEEN_FLUSH_THRESHOLD = 500
+
+LAST_SEEN_QUERY = """
+    INSERT INTO last_seen (id, time, guaranteed_time)
+      VALUES (:id, :time, :guaranteed_time)
+        ON CONFLICT (id) DO UPDATE
+          SET time = :time,
+              guaranteed_time = COALESCE(:guaranteed_time, guaranteed_time)
+"""
+
 
 class Experimental(Cog):
     def __init__(self, bot: utils.Bot):
         self.bot = bot
 
+        # user id -> (time, guaranteed_time), guaranteed_time is None for unsure activity
+        self.pending_last_seen: Dict[int, Tuple[int, Optional[int]]] = {}
+        self.flushing_last_seen: Dict[int, Tuple[int, Optional[int]]] = {}
+        self._flush_lock = asyncio.Lock()
+
+        self.flush_last_seen.start()  # pylint: disable=no-member
+
+        self.bot.router.subscribe("message", self.on_message)
+        self.bot.router.subscribe("raw_reaction_add", self.on_raw_reaction_add)
+
+    def cog_unload(self):
+        self.bot.router.unsubscribe(self)
+        self.flush_last_seen.cancel()  # pylint: disable=no-member
+        self.bot.loop.create_task(self.cog_flush())
+
+    async def cog_flush(self):
+        """Writes every buffered last seen update to the database in one transaction."""
+        async with self._flush_lock:
+            if not self.pending_last_seen:
+                return
+
+            batch, self.pending_last_seen = self.pending_last_seen, {}
+            self.flushing_last_seen = batch
+            parameters = [
+                {"id": user_id, "time": time, "guaranteed_time": guaranteed_time}
+                for user_id, (time, guaranteed_time) in batch.items()
+            ]
+
+            try:
+                await asyncio.shield(self.bot.db.executemany(LAST_SEEN_QUERY, parameters))
+            except Exception:
+                # put the batch back without overwriting anything newer that came in meanwhile
+                for user_id, (time, guaranteed_time) in batch.items():
+                    if user_id not in self.pending_last_seen:
+                        self.pending_last_seen[user_id] = time, guaranteed_time
+                    elif self.pending_last_seen[user_id][1] is None:
+                        self.pending_last_seen[user_id] = (
+                            self.pending_last_seen[user_id][0], guaranteed_time
+                        )
+                raise
+            finally:
+                self.flushing_last_seen = {}
+
+    @tasks.loop(seconds=LAST_SEEN_FLUSH_INTERVAL)
+    async def flush_last_seen(self):
+        try:
+            await self.cog_flush()
+        except Exception:  # pylint: disable=broad-except
+            # keep the loop alive, the batch was put back and gets retried next time
+            traceback.print_exc()
+
     async def update_last_seen(self, member: Union[Member, User],
                                timestamp: int, *, unsure: bool = False):
+        """Buffers a last seen update, only the newest one per user is kept."""
         if unsure:
-            query = """
-                INSERT INTO last_seen (id, time)
-                  VALUES (:id, :time)
-                    ON CONFLICT (id) DO UPDATE
-                      SET time = :time WHERE id = :id
-            """
-
+            previous = self.pending_last_seen.get(member.id)
+            guaranteed_time = previous[1] if previous else None
         else:
-            query = """
-                INSERT INTO last_seen (id, time, guaranteed_time)
-                  VALUES (:id, :time, :time)
-                    ON CONFLICT (id) DO UPDATE
-                      SET time = :time, guaranteed_time = :time WHERE id = :id
-            """
+            guaranteed_time = timestamp
+
+        self.pending_last_seen[member.id] = timestamp, guaranteed_time
+
+        if len(self.pending_last_seen) >= LAST_SEEN_FLUSH_THRESHOLD \
+           and not self._flush_lock.locked():
+            self.bot.loop.create_task(self.cog_flush())
+
+    async def get_last_seen(self, user_id: int) -> Optional[Dict[str, int]]:
+        """Gets a user's last seen times, reading through the write buffers."""
+        row = await self.bot.db.fetchone("SELECT * FROM last_seen WHERE id = ?", user_id)
+        data = dict(row) if row else None
+
+        for buffer in (self.flushing_last_seen, self.pending_last_seen):
+            if not (pending := buffer.get(user_id)):
+                continue
 
-        await self.bot.db.execute(query, {"id": member.id, "time": timestamp})
+            time, guaranteed_time = pending
+            if data is None:
+                data = {"id": user_id, "time": time, "guaranteed_time": guaranteed_time}
+            else:
+                data["time"] = time
+                if guaranteed_time is not None:
+                    data["guaranteed_time"] = guaranteed_time
+
+        return data
 
     @Cog.listener()
     async def on_typing(self, channel: abc.Messageable,
                         user: Union[Member, User], when: datetime):
         await self.update_last_seen(user, int(when.timestamp()))
 
-    @Cog.listener()
     async def on_message(self, message: Message):
         await self.update_last_seen(
             message.author, int(message.created_at.timestamp())
@@ -92,7 +169,6 @@ class Experimental(Cog):
                     int(datetime.utcnow().timestamp())
                 )
 
-    @Cog.listener()
     async def on_raw_reaction_add(self, payload: RawReactionActionEvent):
         await self.update_last_seen(
             self.bot.get_user(payload.user_id),
@@ -152,9 +228,7 @@ class Experimental(Cog):
         if isinstance(user, Member) and user.status != discord.Status.offline:
             await self.update_last_seen(user, int(datetime.utcnow().timestamp()))
 
-        last_seen = await self.bot.db.fetchone(
-            "SELECT * FROM last_seen WHERE id = ?", user.id
-        )
+        last_seen = await self.get_last_seen(user.id)
 
         if not last_seen:
             ls_value = r"¯\\\_(ツ)\_/¯"
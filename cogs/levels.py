@@ -21,14 +21,18 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import os
 import random
-from functools import partial
+import traceback
+from dataclasses import dataclass
+from functools import lru_cache
 from io import BytesIO
 from math import ceil, floor
-from sqlite3 import Row
+from typing import Optional, Tuple
 
+import aiohttp
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import Cog, Context
 from PIL import Image, ImageChops, ImageDraw, ImageFont
 
@@ -54,78 +58,215 @@ GREY = "#808080"
 TRANSPARENT = "#00000000"
 WHITE = "#FFFFFF"
 
+AVATAR_SIZE = (215, 215)
+
+# Username font sizing, the name shrinks from the largest size until it fits the width
+NAME_MAX_WIDTH = 430
+NAME_LARGEST_SIZE = 60
+NAME_SMALLEST_SIZE = 22
+NAME_CACHE_SIZE = 1024
+
+# Rendered rank cards to keep, one per user at most
+CARD_CACHE_SIZE = 128
+
+# Avatars to keep in memory, AVATAR_CACHE_PATH optionally keeps them on disk too
+AVATAR_CACHE_SIZE = 256
+
+# Seconds between ledger writes, also the most XP a crash can lose
+XP_FLUSH_INTERVAL = 10
+
+# Channels where messages don't earn XP
+XP_BLACKLISTED_CHANNELS = frozenset((
+    527938405951078407,
+    662073837017497600,
+    664303128027332628,
+    662063429879595009
+))
+
+
+class CardRenderer:
+    """Holds the parts of a rank card that are the same for every card:
+       decoded template layers, loaded fonts and the avatar mask.
+    """
+    def __init__(self):
+        self.background = Image.open("./assets/images/DefaultBg.png").convert("RGBA")
+        bar = Image.open("./assets/images/BarPic.png").convert("RGBA")
+        outline = Image.open("./assets/images/outline.png").convert("RGBA")
+
+        # the bar and outline are always drawn on top of the progress fill in the same order,
+        # so they can be merged into a single overlay once
+        self.overlay = Image.new("RGBA", self.background.size, TRANSPARENT)
+        self.overlay.alpha_composite(bar)
+        self.overlay.alpha_composite(outline)
+
+        # exaggerated size for the circle mask, scaled down with lanczos to look smoother
+        size = (AVATAR_SIZE[0] * 5, AVATAR_SIZE[1] * 5)
+        mask = Image.new("L", size, 0)
+        ImageDraw.Draw(mask).ellipse((0, 0) + size, fill=255)
+        self.avatar_mask = mask.resize(AVATAR_SIZE, Image.LANCZOS)
+
+        self._fonts = {}
+        self.fit_name = lru_cache(maxsize=NAME_CACHE_SIZE)(self._fit_name)
+
+    def _fit_name(self, name: str, max_width: int) -> Tuple[int, int]:
+        """Returns the largest bold font size the name fits into max_width with,
+           along with the name's right bound at that size.
+        """
+        def width(size: int) -> int:
+            return self.font(BOLD_FONT, size).getbbox(name, anchor="ls")[2]
+
+        if (r_bound := width(NAME_LARGEST_SIZE)) <= max_width:
+            return NAME_LARGEST_SIZE, r_bound
+
+        # binary search for the largest size that fits, falling back to the smallest size
+        low, high = NAME_SMALLEST_SIZE + 1, NAME_LARGEST_SIZE - 1
+        size = NAME_SMALLEST_SIZE
+
+        while low <= high:
+            middle = (low + high) // 2
+            if width(middle) <= max_width:
+                size = middle
+                low = middle + 1
+            else:
+                high = middle - 1
+
+        return size, width(size)
+
+    def font(self, path: str, size: int) -> ImageFont.FreeTypeFont:
+        """Gets a font at the given size, only loading it the first time."""
+        if (font := self._fonts.get((path, size))) is None:
+            font = self._fonts[path, size] = ImageFont.truetype(path, size)
+        return font
+
+
+_renderer: Optional[CardRenderer] = None
+
+
+def get_renderer() -> CardRenderer:
+    """Gets this process's card renderer, creating it on first use."""
+    global _renderer  # pylint: disable=global-statement
+    if _renderer is None:
+        _renderer = CardRenderer()
+    return _renderer
+
+
+def warm_render_worker():
+    """Called by each render worker as it starts, loads the templates and fonts up front."""
+    renderer = get_renderer()
+    for size in (30, 20, 14):
+        renderer.font(REGULAR_FONT, size)
+    renderer.font(BOLD_FONT, NAME_LARGEST_SIZE)
+
+
+@dataclass(frozen=True)
+class CardData:
+    """Everything a rank card shows, apart from the avatar.
+       Plain values only so it can be sent to a render worker.
+    """
+    name: str
+    discriminator: str
+    xp: int
+    level: int
+    level_xp: int
+    position: int
+    total_users: int
+
+    @classmethod
+    def from_ranked_user(cls, user: utils.RankedUser, total_users: int) -> "CardData":
+        return cls(
+            user.full.name, user.full.discriminator, user.xp,
+            user.level, user.level_xp, user.position, total_users
+        )
+
 
 class Levels(Cog):
     def __init__(self, bot: utils.Bot):
         self.bot = bot
+        self.ledger = bot.xp_ledger
+        # user id -> (everything the card was drawn from, png bytes)
+        self.card_cache = utils.LRUCache(CARD_CACHE_SIZE)
+        self.avatar_cache = utils.AvatarCache(
+            bot.session,
+            maxsize=AVATAR_CACHE_SIZE,
+            directory=os.getenv("AVATAR_CACHE_PATH")
+        )
         self.levelup_channel = self.bot.get_channel(668535454580211768)
 
+        self.bot.loop.create_task(self.ledger.load())
+        self.flush_xp.start()  # pylint: disable=no-member
+
+        self.bot.router.subscribe(
+            "message", self.give_xp,
+            guilds=[utils.CEAPA_COOL_ID],
+            exclude_channels=XP_BLACKLISTED_CHANNELS,
+            authors=[utils.AUTHOR_USER]
+        )
+
+    def cog_unload(self):
+        self.bot.router.unsubscribe(self)
+        self.flush_xp.cancel()  # pylint: disable=no-member
+        self.bot.loop.create_task(self.cog_flush())
+
+    async def cog_flush(self):
+        """Writes all changed levels rows to the database."""
+        await self.ledger.flush()
+
+    @tasks.loop(seconds=XP_FLUSH_INTERVAL)
+    async def flush_xp(self):
+        try:
+            await self.ledger.flush()
+        except Exception:  # pylint: disable=broad-except
+            # the rows stay dirty and get retried next time
+            traceback.print_exc()
+
     @staticmethod
     def get_levelup_xp(level: int):
         return 5 * level**2 + 50*level + 100
 
-    def generate_card(self, user: utils.RankedUser, avatar_bytes: bytes, users: list[Row]):
-        im = Image.open("./assets/images/DefaultBg.png").convert("RGBA")
-        bar = Image.open("./assets/images/BarPic.png").convert("RGBA")
-        out = Image.open("./assets/images/outline.png").convert("RGBA")
+    @staticmethod
+    def generate_card(card: CardData, avatar_bytes: bytes) -> BytesIO:
+        """Draws a rank card, runs in a render worker process."""
+        renderer = get_renderer()
+        im = renderer.background.copy()
 
-        level = user.level
-        level_xp = user.level_xp
-        levelup_xp = self.get_levelup_xp(level)
+        level = card.level
+        level_xp = card.level_xp
+        levelup_xp = Levels.get_levelup_xp(level)
 
         level_prog = level_xp / levelup_xp
         bar_length = floor(552 * level_prog)  # calculate progress bar length, 552 is 100%
 
-        # new layer for the bar fill -> draw the bar at the right position -> merge bar on top
-        fill = Image.new("RGBA", im.size, TRANSPARENT)
-        ImageDraw.Draw(fill).rectangle((222, 189, 222+bar_length, 245), BAR_COLOR)
-        fill.alpha_composite(bar)
-
-        # merge bar on top of the background, and outline on top of those
-        im.alpha_composite(fill)
-        im.alpha_composite(out)
+        # draw the bar fill at the right position, then the bar and outline on top of it
+        ImageDraw.Draw(im).rectangle((222, 189, 222+bar_length, 245), BAR_COLOR)
+        im.alpha_composite(renderer.overlay)
 
-        avatar = Image.open(BytesIO(avatar_bytes)).convert("RGBA").resize((215, 215), Image.LANCZOS)
-
-        size = (avatar.size[0] * 5, avatar.size[1] * 5)  # exaggerated size for the circle mask
-        mask = Image.new("L", size, 0)
-        ImageDraw.Draw(mask).ellipse((0, 0) + size, fill=255)
-
-        # scale circle mask down with lanczos sampling to make it look smoother
-        mask = mask.resize(avatar.size, Image.LANCZOS)
+        avatar = Image.open(BytesIO(avatar_bytes)).convert("RGBA")
+        avatar = avatar.resize(AVATAR_SIZE, Image.LANCZOS)
 
         # use mask to crop avatar into a circle
         # darker() ensures all existing transparency in the avatar is left unchanged
-        mask = ImageChops.darker(mask, avatar.split()[-1])
+        mask = ImageChops.darker(renderer.avatar_mask, avatar.getchannel("A"))
         avatar.putalpha(mask)
 
-        # paste avatar on an empty layer
-        avy_layer = Image.new("RGBA", im.size, TRANSPARENT)
-        avy_layer.paste(avatar, (56, 32))
-
         # merge avatar on top of everything else (progress bar etc.)
-        im.alpha_composite(avy_layer)
+        im.alpha_composite(avatar, (56, 32))
 
         # All text will be drawn on top the current state, no new layers whatsoever
         # Username, full size/bold white font
-        size = 60
-        n_font = ImageFont.truetype(BOLD_FONT, size)
-
-        # size defaults to 60, decreasing until text is less than 430 pixels wide and at least 23
-        while (r_bound := n_font.getbbox(user.full.name, anchor="ls")[2]) > 430 and size >= 23:
-            size -= 1
-            n_font = ImageFont.truetype(BOLD_FONT, size)
+        # largest size from 60 down to 22 that keeps the name within 430 pixels, cached per name
+        size, r_bound = renderer.fit_name(card.name, NAME_MAX_WIDTH)
+        n_font = renderer.font(BOLD_FONT, size)
 
         t_draw = ImageDraw.Draw(im)
-        t_draw.text((290, 100), user.full.name, WHITE, n_font, "ls")
+        t_draw.text((290, 100), card.name, WHITE, n_font, "ls")
 
         # Discriminator, half size/regular grey font
-        d_font = ImageFont.truetype(REGULAR_FONT, size // 2)
+        d_font = renderer.font(REGULAR_FONT, size // 2)
         discrim_position = (290 + r_bound + 1, 100)  # right after name, plus 1 pixel to separate
-        t_draw.text(discrim_position, f"#{user.full.discriminator}", GREY, d_font, "ls")
+        t_draw.text(discrim_position, f"#{card.discriminator}", GREY, d_font, "ls")
 
         # Stats
-        prog_font = ImageFont.truetype(REGULAR_FONT, 30)
+        prog_font = renderer.font(REGULAR_FONT, 30)
 
         # draw level % in center of bar if it's wide enough, otherwise a bit to its right
         bar_center = (_, center_h) = ((222 + 222+bar_length) // 2, (245 + 189) // 2)
@@ -137,12 +278,12 @@ class Levels(Cog):
             next_to_bar = (222 + max(floor(552 * 0.05), bar_length) + 10, center_h)
             t_draw.text(next_to_bar, f"{floor(level_prog * 100)}%", WHITE, prog_font, "lm")
 
-        col_font = ImageFont.truetype(REGULAR_FONT, 20)
+        col_font = renderer.font(REGULAR_FONT, 20)
 
         # Rank and level
         t_draw.multiline_text(
             (297, 115),
-            f" Rank: #{user.position}/{len(users)}\nLevel: {level}",
+            f" Rank: #{card.position}/{card.total_users}\nLevel: {level}",
             WHITE,
             col_font,
             "la",
@@ -152,7 +293,7 @@ class Levels(Cog):
         # Level XP and total XP
         t_draw.multiline_text(
             (755, 115),
-            f"   XP: {level_xp}/{levelup_xp} XP\nTotal: {user.xp} XP",
+            f"   XP: {level_xp}/{levelup_xp} XP\nTotal: {card.xp} XP",
             WHITE,
             col_font,
             "ra",
@@ -170,7 +311,7 @@ class Levels(Cog):
             n_messages = f"{min_messages} - {max_messages}"
             plural = True
 
-        small_font = ImageFont.truetype(REGULAR_FONT, 14)
+        small_font = renderer.font(REGULAR_FONT, 14)
         t_draw.text(
             (815, 270),
             f"{n_messages} message{'s' if plural else ''} needed to level up",
@@ -191,39 +332,25 @@ class Levels(Cog):
         if member.guild.id != 527932145273143306:
             return
 
-        data = await self.bot.db.fetchone("SELECT * FROM levels WHERE id = ?", member.id)
+        await self.ledger.loaded.wait()
 
-        if not data:
+        if not (data := self.ledger.get(member.id)):
             return
 
         guild = member.guild
         name = str(member)
         avatar_url = str(member.display_avatar.replace(size=512, static_format="png"))
 
-        if name != data["last_known_as"] or avatar_url != data["last_known_avatar_url"]:
-            await self.bot.db.execute(
-                "UPDATE levels SET last_known_as = ?, last_known_avatar_url = ? WHERE id = ?",
-                name,
-                avatar_url,
-                member.id
-            )
+        if name != data.last_known_as or avatar_url != data.last_known_avatar_url:
+            self.ledger.update(member.id, last_known_as=name, last_known_avatar_url=avatar_url)
 
-        if data["level"] >= 5:
-            roles = [guild.get_role(r) for (l, r) in RANKS.items() if data["level"] > l]
+        if data.level >= 5:
+            roles = [guild.get_role(r) for (l, r) in RANKS.items() if data.level > l]
             await member.add_roles(*roles)
 
-    @Cog.listener()
-    async def on_message(self, message: discord.Message):
-        is_blacklisted_channel = message.channel.id in [
-            527938405951078407,
-            662073837017497600,
-            664303128027332628,
-            662063429879595009
-        ]
-        is_not_ceapa_cool = not message.guild or message.guild.id != 527932145273143306
-        is_not_valid_message = message.author.bot or message.type != discord.MessageType.default
-
-        if is_blacklisted_channel or is_not_ceapa_cool or is_not_valid_message:
+    async def give_xp(self, message: discord.Message):
+        """Gives a member XP for a message, at most once a minute."""
+        if message.type != discord.MessageType.default:
             return
 
         bucket = self.bot.xp_cooldown.get_bucket(message)
@@ -232,74 +359,92 @@ class Levels(Cog):
         if is_on_cooldown:
             return
 
-        await self.bot.db.execute(
-            """INSERT OR IGNORE
-                   INTO levels (id, last_known_as, last_known_avatar_url)
-                       VALUES (?, ?, ?)
-            """,
+        await self.ledger.loaded.wait()
+
+        data = self.ledger.ensure(
             message.author.id,
             str(message.author),
             str(message.author.display_avatar.replace(static_format="png"))
         )
-        data = await self.bot.db.fetchone("SELECT * FROM levels WHERE id = ?", message.author.id)
-        level = data["level"]
+        level = data.level
 
         xp_to_add = random.SystemRandom().randint(15, 25)
-        level_xp = data["level_xp"] + xp_to_add
-        xp = data["xp"] + xp_to_add
+        level_xp = data.level_xp + xp_to_add
+        xp = data.xp + xp_to_add
 
         levelup_xp = self.get_levelup_xp(level)
+        leveled_up = level_xp >= levelup_xp
 
-        if level_xp >= levelup_xp:
+        if leveled_up:
             level += 1
             level_xp = level_xp - levelup_xp
-            if (role := message.guild.get_role(RANKS.get(level))):
-                await message.author.add_roles(role)
-                await self.levelup_channel.send(
-                    f"gg {message.author.mention}, you leveled up to level {level}\n"
-                    f"*level reward: {role.name}*"
-                )
-            else:
-                await self.levelup_channel.send(
-                    f"gg {message.author.mention}, you leveled up to level {level}"
-                )
-
-        await self.bot.db.execute(
-            "UPDATE levels SET level = ?, xp = ?, level_xp = ? WHERE id = ?",
-            level,
-            xp,
-            level_xp,
-            message.author.id
-        )
+
+        # update the ledger before any awaits so concurrent messages see the new values
+        self.ledger.update(message.author.id, level=level, xp=xp, level_xp=level_xp)
+        self.card_cache.pop(message.author.id)
+
+        if not leveled_up:
+            return
+
+        if (role := message.guild.get_role(RANKS.get(level))):
+            await message.author.add_roles(role)
+            await self.levelup_channel.send(
+                f"gg {message.author.mention}, you leveled up to level {level}\n"
+                f"*level reward: {role.name}*"
+            )
+        else:
+            await self.levelup_channel.send(
+                f"gg {message.author.mention}, you leveled up to level {level}"
+            )
 
     @Cog.listener()
     async def on_user_update(self, before: discord.User, after: discord.User):
         """Called when a user changes their name, discriminator or avatar."""
+        await self.ledger.loaded.wait()
+
+        if after.id not in self.ledger:
+            return
+
         if str(before) != str(after):
-            await self.bot.db.execute(
-                "UPDATE levels SET last_known_as = ? WHERE id = ?",
-                str(after),
-                after.id
-            )
+            self.ledger.update(after.id, last_known_as=str(after))
         if str(before.display_avatar.url) != str(after.display_avatar.url):
-            await self.bot.db.execute(
-                "UPDATE levels SET last_known_avatar_url = ? WHERE id = ?",
-                str(after.display_avatar.replace(static_format="png", size=512)),
-                after.id
-            )
+            if before.avatar:
+                self.avatar_cache.invalidate(before.avatar.key)
+
+            avatar_url = str(after.display_avatar.replace(static_format="png", size=512))
+            self.ledger.update(after.id, last_known_avatar_url=avatar_url)
 
     @commands.command(aliases=["level"])
     async def rank(self, ctx: Context, *, user: utils.RankedUser = None):
         """Shows a user's rank information."""
         user = user or await utils.RankedUser.convert(ctx, str(ctx.author.id))
 
-        # avatar = await user.full.display_avatar.replace(size=256, format="png").read()
-        avatar = await (await self.bot.fetch_user(user.full.id)).display_avatar.replace(size=256, format="png").read()
-        users = await self.bot.db.fetch("SELECT * FROM levels")
-        func = partial(self.generate_card, user, avatar, users)
+        card = CardData.from_ranked_user(user, len(self.ledger))
 
-        buffer = await self.bot.loop.run_in_executor(None, func)
-        await ctx.send(file=discord.File(buffer, filename="rank.png"))
+        # the cached user is kept up to date by the gateway, so there's no need to fetch it;
+        # use the global avatar rather than a guild specific one
+        asset = user.full.avatar or user.full.default_avatar
+
+        # the avatar hash stands in for the avatar bytes, so a cache hit needs no requests at all
+        key = (card, asset.key)
+
+        if (cached := self.card_cache.get(user.full.id)) and cached[0] == key:
+            image = cached[1]
+        else:
+            try:
+                avatar = await self.avatar_cache.read(asset)
+            except aiohttp.ClientResponseError:
+                # the cached avatar was outdated after all, get the current one from the API
+                fetched = await self.bot.fetch_user(user.full.id)
+                asset = fetched.avatar or fetched.default_avatar
+                avatar = await self.avatar_cache.read(asset)
+                key = (card, asset.key)
+
+            buffer = await self.bot.render_executor.run(self.generate_card, card, avatar)
+            image = buffer.getvalue()
+            self.card_cache[user.full.id] = (key, image)
+
+        await ctx.send(file=discord.File(BytesIO(image), filename="rank.png"))
 
     @commands.command(aliases=["leaderboard", "lb"])
     async def levels(self, ctx: Context):
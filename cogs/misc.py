@@ -22,7 +22,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import asyncio
-from functools import partial
+from functools import lru_cache, partial
 import html
 import imghdr
 import json
@@ -34,7 +34,7 @@ import textwrap
 import time
 from datetime import datetime, timedelta
 from io import BytesIO
-from typing import Optional, Type
+from typing import Optional, Tuple, Type
 from urllib import parse
 
 import aiohttp
@@ -60,6 +60,19 @@ CMYK_REGEX = re.compile(
 REPO = "https://github.com/vveeps/egg/"
 
 
+@lru_cache(maxsize=None)
+def get_cumrat_assets() -> Tuple[Image.Image, ImageFont.FreeTypeFont]:
+    """Loads the cum rat template and font once per process."""
+    image = Image.open("./assets/images/cumrat.png")
+    image.load()
+    return image, ImageFont.truetype("./assets/fonts/angeltears.ttf", size=150)
+
+
+def warm_render_worker():
+    """Called by each render worker as it starts."""
+    get_cumrat_assets()
+
+
 class Misc(Cog):
     """A cog containing miscellaneous commands."""
 
@@ -117,16 +130,16 @@ class Misc(Cog):
             return await ctx.send(embed=embed)
 
         async with ctx.typing():
-            image = await self.bot.loop.run_in_executor(None, self.create_cumrat, text)
+            image = await self.bot.render_executor.run(self.create_cumrat, text)
             await ctx.send(file=discord.File(image, filename=f"cumrat.png"))
 
     @staticmethod
     def create_cumrat(text: str):
         """Takes the provided text and applies it onto the cum rat template."""
         text = textwrap.fill(re.sub(r"[^\w\s]+", "", text), 25, break_long_words=True)
-        font = ImageFont.truetype("./assets/fonts/angeltears.ttf", size=150)
+        template, font = get_cumrat_assets()
 
-        image = Image.open("./assets/images/cumrat.png")
+        image = template.copy()
         draw = ImageDraw.Draw(image)
         buffer = BytesIO()
 
@@ -415,7 +428,7 @@ class Misc(Cog):
 
         data = await self.fetch_color(value.strip("#"), "hex")
 
-        buffer = await self.bot.loop.run_in_executor(None, self.render_color, data["hex"]["value"])
+        buffer = await self.bot.render_executor.run(self.render_color, data["hex"]["value"])
         image = discord.File(buffer, f"{data['hex']['clean']}.png")
 
         embed = discord.Embed(
@@ -541,7 +554,7 @@ class Misc(Cog):
         if "NaN" in data["cmyk"]["value"]:
             return await self.invalid_color(ctx, word)
 
-        buffer = await self.bot.loop.run_in_executor(None, self.render_color, data["hex"]["value"])
+        buffer = await self.bot.render_executor.run(self.render_color, data["hex"]["value"])
         image = discord.File(buffer, f"{data['hex']['clean']}.png")
 
         embed = discord.Embed(
@@ -604,6 +617,10 @@ class Misc(Cog):
         embed.add_field(name="API heartbeat latency", value=f"{api_latency} ms")
         embed.add_field(name="Real latency (typing)", value=f"{typing} ms")
         embed.add_field(name="discord.com", value=f"{site} ms")
+        embed.add_field(
+            name="Render queue",
+            value=f"{self.bot.render_executor.queue_depth} pending"
+        )
 
         await ctx.send(embed=embed)
 
@@ -21,21 +21,41 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import asyncio
+import json
 import re
-from typing import Type
+import traceback
+from typing import Dict, List, Tuple, Type
 
-from discord import Guild, VoiceClient
-from discord.ext import commands
+from discord import Guild, Member, VoiceClient, VoiceState
+from discord.ext import commands, tasks
 from discord.ext.commands import (BucketType, Cog, CommandError,
                                   CommandInvokeError, Context)
 from youtube_dl.utils import ExtractorError
 
-from voice import MusicPlayer, YTDLSource
+from voice import (URL_REGEX, MusicPlayer, Track, YTDLSource, extraction_cache,
+                   extraction_executor)
 from .utils import utils
 from .utils.utils import BaseEmbed, format_time
 
 STREAM_MODE = False
-URL_REGEX = re.compile(r"https?://(?:www\.)?.+")
+# Searches resolved at the same time when queuing several queries
+PLAYLIST_RESOLVE_CONCURRENCY = 4
+# Titles listed in the confirmation embed when queuing several tracks
+PLAYLIST_PREVIEW_SIZE = 10
+QUERY_SEPARATOR = re.compile(r"\s*(?:\||\n)\s*")
+# Seconds between player snapshots, which is also how much playback a crash can lose
+SNAPSHOT_INTERVAL = 15
+PLAYER_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS music_players (
+    guild_id INTEGER PRIMARY KEY,
+    voice_channel_id INTEGER NOT NULL,
+    text_channel_id INTEGER NOT NULL,
+    volume REAL NOT NULL,
+    position REAL NOT NULL,
+    queue TEXT NOT NULL
+);
+"""
 
 
 class PlayerException(CommandError):
@@ -46,27 +66,172 @@ class Music(Cog):
     def __init__(self, bot: utils.Bot):
         self.bot = bot
 
+        if bot.db is not None and extraction_cache.db is None:
+            bot.loop.create_task(extraction_cache.attach(bot.db))
+
+        # stopped by Bot.close, not cog_unload, since reloading this cog keeps using it
+        bot.extraction_executor = extraction_executor
+
+        # guild id -> last snapshot written for its player
+        self.saved_snapshots: Dict[int, tuple] = {}
+        self._snapshot_lock = asyncio.Lock()
+
+        self.save_players.start()  # pylint: disable=no-member
+        self.prune_extraction_cache.start()  # pylint: disable=no-member
+
+    def cog_unload(self):
+        self.save_players.cancel()  # pylint: disable=no-member
+        self.prune_extraction_cache.cancel()  # pylint: disable=no-member
+        self.bot.loop.create_task(self.cog_flush())
+
+    async def cog_flush(self):
+        """Writes a snapshot of every player whose state changed since the last one."""
+        async with self._snapshot_lock:
+            snapshots = [
+                snapshot for player in self.bot.players.values()
+                if (snapshot := player.snapshot())
+                and self.saved_snapshots.get(snapshot[0]) != snapshot
+            ]
+
+            if not snapshots:
+                return
+
+            await self.bot.db.executemany(
+                "INSERT OR REPLACE INTO music_players VALUES (?, ?, ?, ?, ?, ?)", snapshots
+            )
+
+            for snapshot in snapshots:
+                self.saved_snapshots[snapshot[0]] = snapshot
+
+    @tasks.loop(seconds=SNAPSHOT_INTERVAL)
+    async def save_players(self):
+        try:
+            await self.cog_flush()
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+
+    @tasks.loop(hours=6)
+    async def prune_extraction_cache(self):
+        # attaching prunes once on startup, this keeps long uptimes in check
+        try:
+            await extraction_cache.prune()
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+
+    @save_players.before_loop
+    async def restore_players(self):
+        """Restores the players saved before a restart, in channels people are still in.
+           Nothing is extracted until a track is about to play, and the track
+           that was playing resumes from its saved position.
+        """
+        await self.bot.wait_until_ready()
+
+        # this is the snapshot loop's before_loop, an error escaping here would stop it
+        try:
+            await self.bot.db.executescript(PLAYER_SNAPSHOT_SCHEMA)
+            rows = await self.bot.db.fetchall("SELECT * FROM music_players")
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            return
+
+        for row in rows:
+            try:
+                await self.restore_player(*row)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+                try:
+                    await self.forget_player(row[0])
+                except Exception:  # pylint: disable=broad-except
+                    traceback.print_exc()
+
+    async def restore_player(self, guild_id: int, voice_id: int, text_id: int,
+                             volume: float, position: float, queue: str):
+        """Restores a single saved player, or forgets it if it can't be resumed."""
+        if guild_id in self.bot.players:
+            # still running, e.g. after reloading this cog
+            return
+
+        guild = self.bot.get_guild(guild_id)
+        voice = guild and guild.get_channel(voice_id)
+        channel = guild and guild.get_channel(text_id)
+        entries = json.loads(queue)
+
+        if not voice or not channel or not entries \
+           or not any(not member.bot for member in voice.members):
+            return await self.forget_player(guild_id)
+
+        await voice.connect()
+
+        player = self.bot.players[guild_id] = MusicPlayer(self.bot, self, guild, channel)
+        player.volume = volume
+
+        tracks = [Track.from_json(entry) for entry in entries]
+        tracks[0].start = position
+        player.enqueue_many(tracks)
+
+    async def forget_player(self, guild_id: int):
+        """Deletes a player's snapshot so it isn't restored."""
+        async with self._snapshot_lock:
+            self.saved_snapshots.pop(guild_id, None)
+            await self.bot.db.execute("DELETE FROM music_players WHERE guild_id = ?", guild_id)
+
     async def cleanup(self, guild: Guild):
         try:
             await guild.voice_client.disconnect()
         except AttributeError:
             pass
 
+        # before cancelling, since this can run inside the player loop itself
+        await self.forget_player(guild.id)
+
         try:
             self.bot.players[guild.id].player_loop.cancel()
             del self.bot.players[guild.id]
         except KeyError:
             pass
 
+    @Cog.listener()
+    async def on_voice_state_update(self, member: Member, before: VoiceState, after: VoiceState):
+        """Disconnects an idle player as soon as its last listener leaves."""
+        if member.bot or before.channel is None or before.channel == after.channel:
+            return
+
+        vc: VoiceClient = member.guild.voice_client
+        player: MusicPlayer = self.bot.players.get(member.guild.id)
+
+        if vc is None or player is None or vc.channel != before.channel:
+            return
+
+        if player.idle and not player.has_listeners():
+            await self.cleanup(member.guild)
+
     def get_player(self, ctx: Context):
         try:
             player = self.bot.players[ctx.guild.id]
         except KeyError:
-            player = MusicPlayer(ctx)
+            player = MusicPlayer(self.bot, self, ctx.guild, ctx.channel)
             self.bot.players[ctx.guild.id] = player
 
         return player
 
+    async def resolve_queries(self, ctx: Context, queries: List[str]) -> Tuple[List[Track], int]:
+        """Resolves several queries into unresolved tracks, a few at a time.
+           Returns the tracks in the original order and the amount of queries that failed.
+        """
+        semaphore = asyncio.Semaphore(PLAYLIST_RESOLVE_CONCURRENCY)
+
+        async def resolve(query: str) -> Track:
+            if not URL_REGEX.match(query):
+                query = f"ytsearch:{query}"
+
+            async with semaphore:
+                return await YTDLSource.from_query(query, partial=True, ctx=ctx, stream=True)
+
+        results = await asyncio.gather(*map(resolve, queries), return_exceptions=True)
+        tracks = [result for result in results if isinstance(result, Track)]
+
+        return tracks, len(results) - len(tracks)
+
     # async def cog_check(self, ctx: Context) -> bool:
     #     if ctx.author.voice:
     #         return ctx.author.voice.channel.category_id == 788047812729503825
@@ -119,45 +284,45 @@ class Music(Cog):
                 verb = "Playing"
 
                 source = await YTDLSource.from_query(
-                    query, loop=self.bot.loop, ctx=ctx, stream=do_stream
+                    query, ctx=ctx, stream=do_stream
                 )
                 
                 player.current = source
-                player.first_play_id = ctx.message.id
-                await player.queue.put(source)
+                player.first_play = source.track
+                await player.enqueue(source)
 
-                data = source.data
+                track = source.track
 
             else:
                 verb = "Queued"
 
                 if do_stream:
                     source = await YTDLSource.from_query(
-                        query, loop=self.bot.loop, partial=True,
+                        query, partial=True,
                         ctx=ctx, stream=True
                     )
-                    data = source
+                    track = source
                 else:
                     source = await YTDLSource.from_query(
-                        query, loop=self.bot.loop, ctx=ctx, stream=False
+                        query, ctx=ctx, stream=False
                     )
-                    data = source.data
+                    track = source.track
                 
-                await player.queue.put(source)
+                await player.enqueue(source)
 
             embed = BaseEmbed(ctx)
             embed.set_author(
-                name=f"{verb} {data['title']}",
+                name=f"{verb} {track.title}",
                 icon_url=ctx.author.display_avatar.url,
-                url=data["webpage_url"]
+                url=track.webpage_url
             )
 
-            if data["is_live"]:
+            if track.is_live:
                 duration = "🔴 LIVE"
             else:
-                duration = format_time(data["duration"])
+                duration = format_time(track.duration)
 
-            embed.add_field(name="Uploader", value=data["uploader"])
+            embed.add_field(name="Uploader", value=track.uploader)
             embed.add_field(name="Duration", value=duration)
             embed.add_field(name="Requested by", value=ctx.author.mention)
 
@@ -166,12 +331,70 @@ class Music(Cog):
                     name="Position in queue", value=player.queue.qsize()
                 )
 
-            embed.set_thumbnail(url=data["thumbnail"])
+            embed.set_thumbnail(url=track.thumbnail)
             embed.set_footer(text=f"{do_stream = }")
 
             await ctx.send(embed=embed)
 
 
+    @commands.command(aliases=["pl", "playmany"])
+    @commands.max_concurrency(1, per=BucketType.guild, wait=True)
+    async def playlist(self, ctx: Context, *, query: str):
+        """Queues a whole playlist, or several queries separated by | or new lines.
+           The tracks are streamed and only resolved once they're about to play.
+        """
+        player: MusicPlayer = self.get_player(ctx)
+        player.skipped = None
+
+        queries = [q for q in (q.strip("<>") for q in QUERY_SEPARATOR.split(query.strip())) if q]
+
+        async with ctx.typing():
+            failed = 0
+
+            if len(queries) == 1 and URL_REGEX.match(queries[0]):
+                entries = await YTDLSource.from_playlist(queries[0], ctx=ctx)
+            else:
+                entries, failed = await self.resolve_queries(ctx, queries)
+
+            if not entries:
+                embed = BaseEmbed(ctx)
+                embed.set_author(
+                    name="Nothing was found.",
+                    icon_url=ctx.author.display_avatar.url
+                )
+                return await ctx.send(embed=embed)
+
+            start = player.queue.qsize() + 1
+            player.enqueue_many(entries)
+
+            lines = [
+                f"`{start + i}.` {track.title}"
+                for i, track in enumerate(entries[:PLAYLIST_PREVIEW_SIZE])
+            ]
+            if len(entries) > PLAYLIST_PREVIEW_SIZE:
+                lines.append(f"*...and {len(entries) - PLAYLIST_PREVIEW_SIZE} more*")
+
+            embed = BaseEmbed(ctx, description="\n".join(lines))
+            embed.set_author(
+                name=f"Queued {len(entries)} tracks",
+                icon_url=ctx.author.display_avatar.url
+            )
+
+            durations = [track.duration for track in entries if track.duration]
+            if durations:
+                embed.add_field(name="Duration", value=format_time(sum(durations)))
+
+            embed.add_field(name="Requested by", value=ctx.author.mention)
+
+            if failed:
+                embed.add_field(name="Not found", value=failed)
+
+            if (thumbnail := next(filter(None, (track.thumbnail for track in entries)), None)):
+                embed.set_thumbnail(url=thumbnail)
+
+            await ctx.send(embed=embed)
+
+
     @commands.command(aliases=["unpause"])
     async def resume(self, ctx: Context):
         embed = BaseEmbed(ctx)
@@ -190,12 +413,12 @@ class Music(Cog):
         vc: VoiceClient = ctx.voice_client
 
         if player.queue.qsize() > 0:
-            player.current.data["skipper"] = ctx.author
+            player.skipper = ctx.author
             player.skipped = player.current
         else:
             embed = BaseEmbed(ctx, description="End of queue.")
             embed.set_author(
-                name=f"Skipped {player.current.data['title']}",
+                name=f"Skipped {player.current.title}",
                 icon_url=ctx.author.display_avatar.url
             )
 
@@ -234,6 +457,7 @@ class Music(Cog):
 
 
     @play.error
+    @playlist.error
     async def extraction_error_handler(self, ctx: Context,
                                        error: Type[CommandError]):
         if not isinstance(error, CommandInvokeError):
@@ -263,6 +487,7 @@ class Music(Cog):
 
 
     @play.before_invoke
+    @playlist.before_invoke
     async def ensure_voice(self, ctx: Context):
         vc: VoiceClient = ctx.voice_client
 
@@ -31,6 +31,7 @@ import discord
 from discord.ext import commands
 from discord.ext.commands import CheckFailure, Cog, CommandError, Context, NotOwner
 
+from voice import download_cache
 from .utils import utils
 
 EGG_COLOR = 0xF6DECF
@@ -123,6 +124,62 @@ class Owner(Cog):
         await ctx.message.add_reaction("\N{FLUSHED FACE}")
         await self.bot.close()
 
+    @commands.command()
+    async def downloads(self, ctx: Context):
+        """Shows music download cache statistics."""
+        lookups = download_cache.hits + download_cache.misses
+        hit_rate = download_cache.hits / lookups if lookups else 0
+
+        embed = discord.Embed(color=EGG_COLOR, timestamp=ctx.message.created_at)
+        embed.set_author(name="Download cache", icon_url=ctx.me.display_avatar.url)
+        embed.add_field(name="Files", value=f"{len(download_cache)} ({download_cache.in_use} in use)")
+        embed.add_field(
+            name="Size",
+            value=f"{download_cache.size / 2**20:.1f} / {download_cache.max_bytes / 2**20:.0f} MiB"
+        )
+        embed.add_field(name="Hit rate", value=f"{hit_rate:.0%}")
+        embed.add_field(name="Hits", value=download_cache.hits)
+        embed.add_field(name="Misses", value=download_cache.misses)
+        embed.add_field(name="Evictions", value=download_cache.evictions)
+
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    async def listeners(self, ctx: Context):
+        """Shows how many events the router handled and what each subscriber cost."""
+        router = self.bot.router
+        subscriptions = sorted(
+            (s for subs in router.subscriptions.values() for s in subs),
+            key=lambda s: s.total_time,
+            reverse=True
+        )
+
+        embed = discord.Embed(color=EGG_COLOR, timestamp=ctx.message.created_at)
+        embed.set_author(name="Event router", icon_url=ctx.me.display_avatar.url)
+        embed.description = "\n".join(f"{event}: {count}" for event, count in router.events.items())
+
+        remover = self.bot.reaction_remover
+        embed.description += (
+            f"\n\nReaction removals: {remover.queued} queued, {remover.requests} requests"
+        )
+
+        if (events := self.bot.get_cog("Events")):
+            mod_log = events.mod_log
+            embed.description += (
+                f"\nMod log: {mod_log.sent} sent in {mod_log.messages} messages, "
+                f"{mod_log.dropped} dropped, {len(mod_log.queue)} queued"
+            )
+
+        for subscription in subscriptions[:25]:
+            average = subscription.total_time / subscription.calls if subscription.calls else 0
+            embed.add_field(
+                name=subscription.name,
+                value=f"{subscription.calls} calls, {subscription.errors} errors\n"
+                      f"{average * 1000:.2f} ms avg, {subscription.max_time * 1000:.0f} ms max"
+            )
+
+        await ctx.send(embed=embed)
+
     @commands.group(invoke_without_command=True)
     async def cdn(self, ctx: Context):
         """Command group for managing https://cdn.veeps.moe auth tokens."""
@@ -40,6 +40,12 @@ class Roles(Cog):
 
         self.bot.loop.create_task(self.cache_roles())
 
+        for event in ("raw_reaction_add", "raw_reaction_remove"):
+            self.bot.router.subscribe(event, self.handle_reaction, channels=[self.channel.id])
+
+    def cog_unload(self):
+        self.bot.router.unsubscribe(self)
+
     async def cache_roles(self):
         data = await self.bot.db.fetch("SELECT * FROM roles")
         for i in data:
@@ -172,25 +178,22 @@ class Roles(Cog):
 
         await ctx.message.add_reaction(SUCCESS_EMOJI)
 
-    @Cog.listener(name="on_raw_reaction_add")
-    @Cog.listener(name="on_raw_reaction_remove")
     async def handle_reaction(self, payload: RawReactionActionEvent):
-        if payload.channel_id != self.channel.id:
-            return
-
         if payload.user_id == self.bot.user.id:
             return
 
         emoji = payload.emoji
-        guild = self.bot.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
 
         if str(emoji) not in self.role_dict:
-            message = await self.channel.fetch_message(payload.message_id)
-            await message.remove_reaction(emoji, member)
+            # removals of reactions that were already stripped need no cleanup
+            if payload.event_type == "REACTION_ADD":
+                self.bot.reaction_remover.remove(
+                    payload.channel_id, payload.message_id, emoji, payload.user_id
+                )
             return
 
         guild = self.bot.get_guild(payload.guild_id)
+        member = guild.get_member(payload.user_id)
         role_id = self.role_dict[str(emoji)]["role_id"]
         role = guild.get_role(role_id)
 
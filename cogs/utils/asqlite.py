@@ -220,6 +220,13 @@ class Connection:
         """Retrieves the internal :class:`sqlite3.Connection` object."""
         return self._conn
 
+    async def run(self, func, *args, **kwargs):
+        """Calls ``func`` on the worker thread with the internal
+        :class:`sqlite3.Connection` as its first argument.
+        This lets a whole unit of work run in a single round trip.
+        """
+        return await self._post(func, self._conn, *args, **kwargs)
+
     def transaction(self):
         """Gets a transaction object.
         This can be used similarly to ``asyncpg.Transaction``.
@@ -1,73 +1,758 @@
 """Utility functions and other helper things for the bot."""
+import asyncio
+import importlib
 import io
+import itertools
 import math
+import multiprocessing
 import os
 import re
+import sqlite3
 import traceback
 from asyncio import TimeoutError
+from collections import OrderedDict, deque
+from bisect import bisect_left, insort
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from sqlite3 import Row
-from typing import Any, List, Iterable, Sequence, Tuple, Type, Union
+from time import perf_counter
+from typing import (Any, Callable, Deque, Dict, FrozenSet, Iterable, Iterator, List, NamedTuple,
+                    Optional, Sequence, Set, Tuple, Type, Union)
 
 import parsedatetime as pdt
-from aiohttp import ClientSession
-from discord import Asset, Embed, Member, NotFound, Reaction, User
+from aiohttp import ClientError, ClientSession
+from discord import (Asset, Embed, HTTPException, Member, Message, NotFound, Object,
+                     PartialEmoji, RawReactionActionEvent, Reaction, User)
 from discord.ext import commands
 from discord.ext.commands import BadArgument, BucketType, Context, Converter, CooldownMapping
-from discord.utils import find
+from discord.utils import find, time_snowflake
 from PIL import Image
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from . import asqlite
 
 EGG_COLOR = 0xF6DECF
+CEAPA_COOL_ID = 527932145273143306
+
+
+def _parameters(parameters: tuple) -> Union[tuple, dict]:
+    if len(parameters) == 1 and isinstance(parameters[0], (dict, tuple)):
+        return parameters[0]
+    return parameters
+
+
+def _execute(connection: sqlite3.Connection, query: str, parameters: tuple) -> None:
+    connection.execute(query, parameters)
+
+
+def _executemany(connection: sqlite3.Connection, query: str,
+                 parameter_seq: Sequence[Sequence[Any]]) -> None:
+    # the connection is in autocommit mode, so wrap the batch in a single transaction
+    connection.execute("BEGIN")
+    try:
+        connection.executemany(query, parameter_seq)
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def _executescript(connection: sqlite3.Connection, script: str) -> None:
+    connection.executescript(script)
+
+
+def _fetchall(connection: sqlite3.Connection, query: str, parameters: tuple) -> List[Row]:
+    return connection.execute(query, parameters).fetchall()
+
+
+def _fetchmany(connection: sqlite3.Connection, query: str,
+               parameters: tuple, size: Optional[int]) -> List[Row]:
+    cursor = connection.execute(query, parameters)
+    return cursor.fetchmany(cursor.arraysize if size is None else size)
+
+
+def _fetchone(connection: sqlite3.Connection, query: str, parameters: tuple) -> Row:
+    return connection.execute(query, parameters).fetchone()
+
+
+def _query_only(connection: sqlite3.Connection) -> None:
+    connection.execute("pragma query_only=ON")
 
 
 class Database:
-    """Shortcuts for various asqlite cursor methods."""
-    def __init__(self, path) -> None:
+    """Shortcuts for various asqlite cursor methods.
+
+       Keeps one writer and a few reader connections open for the bot's lifetime,
+       each on its own worker thread. Every call is a single round trip to a worker.
+    """
+    def __init__(self, path: str, *, readers: int = 3) -> None:
         self.path = path
+        self.reader_count = readers
+
+        self._writer: Optional[asqlite.Connection] = None
+        self._readers: List[asqlite.Connection] = []
+        self._reader_cycle: Optional[Iterator[asqlite.Connection]] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Whether the connection pool is currently open."""
+        return self._writer is not None
+
+    async def open(self) -> None:
+        """Opens the writer and reader connections if they aren't open yet."""
+        async with self._lock:
+            if self._writer is not None:
+                return
+
+            writer = await asqlite.connect(self.path)
+            readers = [
+                await asqlite.connect(self.path, init=_query_only)
+                for _ in range(self.reader_count)
+            ]
+
+            self._readers = readers
+            self._reader_cycle = itertools.cycle(readers)
+            self._writer = writer
+
+    async def close(self) -> None:
+        """Closes every pooled connection and stops their worker threads."""
+        async with self._lock:
+            if self._writer is None:
+                return
+
+            for connection in (self._writer, *self._readers):
+                await connection.close()
+
+            self._writer = None
+            self._readers = []
+            self._reader_cycle = None
+
+    async def _write(self, func: Callable, *args) -> Any:
+        if self._writer is None:
+            await self.open()
+        return await self._writer.run(func, *args)
+
+    async def _read(self, func: Callable, *args) -> Any:
+        if self._writer is None:
+            await self.open()
+        if not self._readers:
+            return await self._writer.run(func, *args)
+        return await next(self._reader_cycle).run(func, *args)
 
     async def execute(self, query: str, *parameters) -> None:
         """Executes an SQL query."""
-        async with asqlite.connect(self.path) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, *parameters)
+        await self._write(_execute, query, _parameters(parameters))
 
     async def executemany(self, query: str, parameter_seq: Sequence[Sequence[Any]]) -> None:
-        """Executes a query for all parameter sequences."""
-        async with asqlite.connect(self.path) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.executemany(query, parameter_seq)
+        """Executes a query for all parameter sequences in a single transaction."""
+        await self._write(_executemany, query, list(parameter_seq))
 
     async def executescript(self, script: str) -> None:
         """Executes an SQL script."""
-        async with asqlite.connect(self.path) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.executescript(script)
+        await self._write(_executescript, script)
 
     async def fetchall(self, query: str, *parameters) -> List[Row]:
         """Executes an SQL query and fetches all returned rows."""
-        async with asqlite.connect(self.path) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, *parameters)
-                return await cursor.fetchall()
+        return await self._read(_fetchall, query, _parameters(parameters))
 
     fetch = fetchall
 
     async def fetchmany(self, query: str, *parameters, size: int = None) -> List[Row]:
         """Executes an SQL query and fetches the desired amount of returned rows."""
-        async with asqlite.connect(self.path) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, *parameters)
-                return await cursor.fetchmany(size)
+        return await self._read(_fetchmany, query, _parameters(parameters), size)
 
     async def fetchone(self, query: str, *parameters) -> Row:
         """Executes an SQL query and fetches the first returned row."""
-        async with asqlite.connect(self.path) as connection:
-            async with connection.cursor() as cursor:
-                await cursor.execute(query, *parameters)
-                return await cursor.fetchone()
+        return await self._read(_fetchone, query, _parameters(parameters))
+
+
+@dataclass
+class LevelRow:
+    """In-memory copy of a row in the levels table."""
+    id: int  # pylint: disable=invalid-name
+    xp: int = 0
+    level: int = 0
+    level_xp: int = 0
+    last_known_as: Optional[str] = None
+    last_known_avatar_url: Optional[str] = None
+
+    def as_parameters(self) -> Tuple[int, int, int, int, Optional[str], Optional[str]]:
+        """Returns the row's values in the order LEVELS_UPSERT expects them."""
+        return (
+            self.id, self.xp, self.level, self.level_xp,
+            self.last_known_as, self.last_known_avatar_url
+        )
+
+
+class RankIndex:
+    """Order-statistics index of user ids, sorted by xp from highest to lowest.
+
+       Keys live in sorted buckets with a Fenwick tree over the bucket sizes,
+       so inserts, removals, rank lookups and position lookups are all O(log n).
+    """
+    LOAD = 256
+
+    def __init__(self, rows: Iterable[LevelRow] = ()) -> None:
+        self._keys: Dict[int, Tuple[int, int]] = {}
+        self._buckets: List[List[Tuple[int, int]]] = []
+        self._maxes: List[Tuple[int, int]] = []
+        self._tree: List[int] = [0]
+        self.rebuild(rows)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._keys
+
+    def rebuild(self, rows: Iterable[LevelRow]) -> None:
+        """Replaces the index's contents with the given rows."""
+        self._keys = {row.id: (-row.xp, row.id) for row in rows}
+        keys = sorted(self._keys.values())
+
+        self._buckets = slicer(keys, self.LOAD)
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._build_tree()
+
+    def _build_tree(self) -> None:
+        size = len(self._buckets)
+        tree = [0] * (size + 1)
+
+        for i, bucket in enumerate(self._buckets, start=1):
+            tree[i] += len(bucket)
+            if (parent := i + (i & -i)) <= size:
+                tree[parent] += tree[i]
+
+        self._tree = tree
+
+    def _tree_add(self, index: int, delta: int) -> None:
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def _tree_prefix(self, index: int) -> int:
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def _tree_find(self, position: int) -> Tuple[int, int]:
+        # returns the bucket holding the position and the offset inside that bucket
+        index = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+
+        while step:
+            if (nxt := index + step) < len(self._tree) and self._tree[nxt] <= position:
+                index = nxt
+                position -= self._tree[nxt]
+            step >>= 1
+
+        return index, position
+
+    def _insert(self, key: Tuple[int, int]) -> None:
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._build_tree()
+            return
+
+        index = min(bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[index]
+        insort(bucket, key)
+        self._maxes[index] = bucket[-1]
+
+        if len(bucket) > self.LOAD * 2:
+            half = len(bucket) // 2
+            self._buckets[index:index + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[index:index + 1] = [bucket[half - 1], bucket[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(index, 1)
+
+    def _remove(self, key: Tuple[int, int]) -> None:
+        index = bisect_left(self._maxes, key)
+        bucket = self._buckets[index]
+        del bucket[bisect_left(bucket, key)]
+
+        if not bucket:
+            del self._buckets[index]
+            del self._maxes[index]
+            self._build_tree()
+        else:
+            self._maxes[index] = bucket[-1]
+            self._tree_add(index, -1)
+
+    def set(self, user_id: int, xp: int) -> None:  # pylint: disable=invalid-name
+        """Adds a user to the index or moves them to their new xp."""
+        key = (-xp, user_id)
+
+        if (old := self._keys.get(user_id)) == key:
+            return
+        if old is not None:
+            self._remove(old)
+
+        self._keys[user_id] = key
+        self._insert(key)
+
+    def discard(self, user_id: int) -> None:
+        """Removes a user from the index if they're in it."""
+        if (key := self._keys.pop(user_id, None)) is not None:
+            self._remove(key)
+
+    def position(self, user_id: int) -> int:
+        """Gets a user's 0-indexed position on the leaderboard."""
+        key = self._keys[user_id]
+        index = bisect_left(self._maxes, key)
+        return self._tree_prefix(index) + bisect_left(self._buckets[index], key)
+
+    def at(self, position: int) -> int:  # pylint: disable=invalid-name
+        """Gets the id of the user at the given 0-indexed leaderboard position."""
+        if not 0 <= position < len(self._keys):
+            raise IndexError("leaderboard position out of range")
+
+        index, offset = self._tree_find(position)
+        return self._buckets[index][offset][1]
+
+
+LEVELS_UPSERT = """
+    INSERT INTO levels (id, xp, level, level_xp, last_known_as, last_known_avatar_url)
+      VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE
+          SET xp = excluded.xp,
+              level = excluded.level,
+              level_xp = excluded.level_xp,
+              last_known_as = excluded.last_known_as,
+              last_known_avatar_url = excluded.last_known_avatar_url
+"""
+
+
+class XPLedger:
+    """Write-back cache of the levels table.
+
+       Rows are loaded once and changed in memory only, dirty rows are written back
+       in a single transaction whenever flush() is called.
+    """
+    def __init__(self, db: Database) -> None:
+        self.db = db  # pylint: disable=invalid-name
+        self.rows: Dict[int, LevelRow] = {}
+        self.ranks = RankIndex()
+        self.dirty: Set[int] = set()
+        self.loaded = asyncio.Event()
+
+        self._load_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.rows
+
+    async def load(self) -> None:
+        """Loads every row of the levels table, does nothing if already loaded."""
+        async with self._load_lock:
+            if self.loaded.is_set():
+                return
+
+            rows = await self.db.fetchall(
+                """SELECT id, xp, level, level_xp, last_known_as, last_known_avatar_url
+                       FROM levels
+                """
+            )
+            self.rows = {row["id"]: LevelRow(*row) for row in rows}
+            self.ranks.rebuild(self.rows.values())
+            self.loaded.set()
+
+    def get(self, user_id: int) -> Optional[LevelRow]:
+        """Gets a user's row, or None if they don't have one."""
+        return self.rows.get(user_id)
+
+    def ensure(self, user_id: int, name: str, avatar_url: str) -> LevelRow:
+        """Gets a user's row, creating an empty one if they don't have one yet."""
+        if (row := self.rows.get(user_id)):
+            return row
+
+        row = self.rows[user_id] = LevelRow(
+            user_id, last_known_as=name, last_known_avatar_url=avatar_url
+        )
+        self.ranks.set(user_id, row.xp)
+        self.dirty.add(user_id)
+        return row
+
+    def update(self, user_id: int, **values: Any) -> None:
+        """Sets the given columns of an existing row and marks it for writing."""
+        row = self.rows[user_id]
+
+        for column, value in values.items():
+            setattr(row, column, value)
+
+        if "xp" in values:
+            self.ranks.set(user_id, row.xp)
+
+        self.dirty.add(user_id)
+
+    async def flush(self) -> None:
+        """Writes every changed row to the database in one transaction."""
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+
+            batch, self.dirty = self.dirty, set()
+            parameters = [self.rows[user_id].as_parameters() for user_id in batch]
+
+            try:
+                await asyncio.shield(self.db.executemany(LEVELS_UPSERT, parameters))
+            except BaseException:
+                self.dirty |= batch
+                raise
+
+
+MESSAGE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS message_store (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    attachments INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class StoredMessage(NamedTuple):
+    """A row of the message_store table."""
+    message_id: int
+    channel_id: int
+    author_id: int
+    content: str
+    attachments: int
+
+
+class MessageStore:
+    """Ring buffer of recent message contents in SQLite.
+
+       Lets the delete and edit logs show messages that discord.py no longer has cached.
+       Writes are buffered and flushed in one transaction, and prune() drops rows older
+       than retention as well as the oldest rows past max_rows. Rows are keyed by message
+       id, and since snowflakes grow with time, the oldest messages are the lowest ids.
+    """
+    def __init__(self, db: Database, *, retention: timedelta = timedelta(days=14),
+                 max_rows: int = 250_000) -> None:
+        self.db = db  # pylint: disable=invalid-name
+        self.retention = retention
+        self.max_rows = max_rows
+
+        self.pending: Dict[int, StoredMessage] = {}
+        self.flushing: Dict[int, StoredMessage] = {}
+        self.ready = asyncio.Event()
+
+        self._flush_lock = asyncio.Lock()
+
+    async def setup(self) -> None:
+        """Creates the table if it doesn't exist yet."""
+        await self.db.executescript(MESSAGE_STORE_SCHEMA)
+        self.ready.set()
+
+    def add(self, message_id: int, channel_id: int, author_id: int,
+            content: str, attachments: int = 0) -> None:
+        """Stores a message, replacing whatever was stored for it before."""
+        self.pending[message_id] = StoredMessage(
+            message_id, channel_id, author_id, content, attachments
+        )
+
+    async def get(self, message_id: int) -> Optional[StoredMessage]:
+        """Gets a stored message, reading through the write buffers."""
+        for buffer in (self.pending, self.flushing):
+            if (message := buffer.get(message_id)):
+                return message
+
+        await self.ready.wait()
+        row = await self.db.fetchone(
+            "SELECT * FROM message_store WHERE message_id = ?", message_id
+        )
+        return StoredMessage(*row) if row else None
+
+    async def flush(self) -> None:
+        """Writes every buffered message in one transaction."""
+        async with self._flush_lock:
+            if not self.pending:
+                return
+
+            await self.ready.wait()
+            batch, self.pending = self.pending, {}
+            self.flushing = batch
+
+            try:
+                await asyncio.shield(self.db.executemany(
+                    "INSERT OR REPLACE INTO message_store VALUES (?, ?, ?, ?, ?)",
+                    list(batch.values())
+                ))
+            except BaseException:
+                # newer versions of the same messages win
+                self.pending = {**batch, **self.pending}
+                raise
+            finally:
+                self.flushing = {}
+
+    async def prune(self) -> None:
+        """Deletes messages older than the retention period and the oldest past max_rows."""
+        await self.ready.wait()
+        cutoff = time_snowflake(datetime.now(timezone.utc) - self.retention)
+
+        await self.db.execute("DELETE FROM message_store WHERE message_id < ?", cutoff)
+        await self.db.execute(
+            """DELETE FROM message_store WHERE message_id <= (
+                   SELECT message_id FROM message_store
+                     ORDER BY message_id DESC LIMIT 1 OFFSET ?
+               )
+            """,
+            self.max_rows
+        )
+
+
+# Modules whose warm_render_worker() gets called in each render worker as it starts
+RENDER_WORKER_MODULES = ("cogs.levels", "cogs.misc")
+
+
+def _init_render_worker() -> None:
+    for name in RENDER_WORKER_MODULES:
+        module = importlib.import_module(name)
+        if (warm_up := getattr(module, "warm_render_worker", None)):
+            warm_up()
+
+
+def _render_worker_ready() -> int:
+    return os.getpid()
+
+
+class RenderExecutor:
+    """Process pool for CPU-bound image rendering.
+
+       PIL holds the GIL for long stretches, so rendering in separate processes keeps
+       the gateway heartbeat and other commands responsive. Workers are forked up front,
+       before the bot starts any threads, and load their templates and fonts right away.
+       If a worker dies later on, the replacement pool is started through a forkserver
+       instead, since forking a process that has threads running can deadlock the child.
+       Functions passed to run() must be picklable, e.g. module level functions.
+    """
+    def __init__(self, workers: int = 2, *, max_pending: int = 8) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+
+        self._semaphore = asyncio.Semaphore(max_pending)
+        self._pool = self._create_pool("fork")
+
+    def _create_pool(self, start_method: str) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_render_worker
+        )
+
+        # submitting one job per worker at once makes the pool start all of them now
+        for _ in range(self.workers):
+            pool.submit(_render_worker_ready)
+
+        return pool
+
+    @property
+    def queue_depth(self) -> int:
+        """Amount of render jobs that are either running or waiting for a worker."""
+        return self.pending
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        """Runs func(*args) in a worker process and returns its result."""
+        self.pending += 1
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                pool = self._pool
+                try:
+                    return await loop.run_in_executor(pool, partial(func, *args))
+                except BrokenProcessPool:
+                    # a worker died, replace the pool so the next job has somewhere to go,
+                    # unless another job that failed on the same pool already did
+                    if self._pool is pool:
+                        pool.shutdown(wait=False)
+                        self._pool = self._create_pool("forkserver")
+                    raise
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        """Stops all worker processes."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+AUTHOR_USER = "user"
+AUTHOR_BOT = "bot"
+AUTHOR_WEBHOOK = "webhook"
+ALL_AUTHORS = frozenset((AUTHOR_USER, AUTHOR_BOT, AUTHOR_WEBHOOK))
+
+# Gateway events that EventRouter classifies and fans out
+ROUTED_EVENTS = ("message", "raw_reaction_add", "raw_reaction_remove")
+
+
+class Route(NamedTuple):
+    """Where an event happened and who caused it."""
+    guild_id: Optional[int]
+    channel_id: int
+    category_id: Optional[int]
+    author: str
+
+
+@dataclass
+class Subscription:
+    """A routed event callback, its filters and what it has cost so far.
+
+       None for guilds, channels or categories means any.
+    """
+    callback: Callable
+    guilds: Optional[FrozenSet[int]] = None
+    channels: Optional[FrozenSet[int]] = None
+    categories: Optional[FrozenSet[int]] = None
+    exclude_channels: FrozenSet[int] = frozenset()
+    authors: FrozenSet[str] = ALL_AUTHORS
+
+    calls: int = 0
+    errors: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    @property
+    def name(self) -> str:
+        """The callback's qualified name, e.g. Levels.on_message."""
+        return self.callback.__qualname__
+
+    def matches(self, route: Route) -> bool:
+        """Whether an event with the given route passes every filter."""
+        return (
+            (self.guilds is None or route.guild_id in self.guilds)
+            and (self.channels is None or route.channel_id in self.channels)
+            and (self.categories is None or route.category_id in self.categories)
+            and route.channel_id not in self.exclude_channels
+            and route.author in self.authors
+        )
+
+
+class EventRouter:
+    """Classifies message and reaction events once and fans them out to subscribers.
+
+       Cogs subscribe with filters instead of each adding its own listener and repeating
+       the same guild, channel and author checks. The subscribers matching a route are
+       worked out once and cached until the subscriptions change, and every callback's
+       call count and run time are kept for the listeners command.
+    """
+    def __init__(self, bot: "Bot") -> None:
+        self.bot = bot
+
+        self.subscriptions: Dict[str, List[Subscription]] = {event: [] for event in ROUTED_EVENTS}
+        self.events: Dict[str, int] = dict.fromkeys(ROUTED_EVENTS, 0)
+        self._matches: Dict[Tuple[str, Route], Tuple[Subscription, ...]] = {}
+
+        bot.add_listener(self.on_message)
+        bot.add_listener(self.on_raw_reaction_add)
+        bot.add_listener(self.on_raw_reaction_remove)
+
+    def subscribe(self, event: str, callback: Callable, *,
+                  guilds: Iterable[int] = None, channels: Iterable[int] = None,
+                  categories: Iterable[int] = None, exclude_channels: Iterable[int] = (),
+                  authors: Iterable[str] = ALL_AUTHORS) -> Subscription:
+        """Subscribes a coroutine function to one of ROUTED_EVENTS.
+           It gets called with the same arguments as the matching discord.py event.
+        """
+        if event not in self.subscriptions:
+            raise ValueError(f"Event \"{event}\" is not routed.")
+
+        subscription = Subscription(
+            callback,
+            guilds=None if guilds is None else frozenset(guilds),
+            channels=None if channels is None else frozenset(channels),
+            categories=None if categories is None else frozenset(categories),
+            exclude_channels=frozenset(exclude_channels),
+            authors=frozenset(authors)
+        )
+        self.subscriptions[event].append(subscription)
+        self._matches.clear()
+
+        return subscription
+
+    def unsubscribe(self, owner: Any) -> None:
+        """Removes every subscription whose callback is a method of owner, e.g. a cog."""
+        for event, subscriptions in self.subscriptions.items():
+            self.subscriptions[event] = [
+                s for s in subscriptions if getattr(s.callback, "__self__", None) is not owner
+            ]
+        self._matches.clear()
+
+    def dispatch(self, event: str, route: Route, *args: Any) -> None:
+        """Starts every callback subscribed to event that matches route."""
+        self.events[event] += 1
+
+        if (subscriptions := self._matches.get((event, route))) is None:
+            subscriptions = tuple(s for s in self.subscriptions[event] if s.matches(route))
+            self._matches[(event, route)] = subscriptions
+
+        for subscription in subscriptions:
+            self.bot.loop.create_task(self._run(subscription, args))
+
+    async def _run(self, subscription: Subscription, args: tuple) -> None:
+        start = perf_counter()
+        try:
+            await subscription.callback(*args)
+        except Exception:  # pylint: disable=broad-except
+            subscription.errors += 1
+            print(f"Ignoring exception in {subscription.name}")
+            traceback.print_exc()
+        finally:
+            elapsed = perf_counter() - start
+            subscription.calls += 1
+            subscription.total_time += elapsed
+            subscription.max_time = max(subscription.max_time, elapsed)
+
+    async def on_message(self, message: Message) -> None:
+        author = message.author
+
+        if message.webhook_id:
+            kind = AUTHOR_WEBHOOK
+        else:
+            kind = AUTHOR_BOT if author.bot else AUTHOR_USER
+
+        channel = message.channel
+        route = Route(
+            message.guild.id if message.guild else None,
+            channel.id,
+            getattr(channel, "category_id", None),
+            kind
+        )
+        self.dispatch("message", route, message)
+
+    def _reaction_route(self, payload: RawReactionActionEvent) -> Route:
+        channel = self.bot.get_channel(payload.channel_id)
+        user = payload.member or self.bot.get_user(payload.user_id)
+
+        return Route(
+            payload.guild_id,
+            payload.channel_id,
+            getattr(channel, "category_id", None),
+            AUTHOR_BOT if user and user.bot else AUTHOR_USER
+        )
+
+    async def on_raw_reaction_add(self, payload: RawReactionActionEvent) -> None:
+        self.dispatch("raw_reaction_add", self._reaction_route(payload), payload)
+
+    async def on_raw_reaction_remove(self, payload: RawReactionActionEvent) -> None:
+        self.dispatch("raw_reaction_remove", self._reaction_route(payload), payload)
 
 
 class Bot(commands.Bot):
@@ -78,6 +763,12 @@ class Bot(commands.Bot):
         self.session = ClientSession()
 
         self.xp_cooldown = CooldownMapping.from_cooldown(1, 60, BucketType.member)
+        self.xp_ledger = None
+        self.render_executor = RenderExecutor()
+        # set by the music cog, voice.py imports this module so it can't be imported here
+        self.extraction_executor = None
+        self.router = EventRouter(self)
+        self.reaction_remover = ReactionRemover(self)
 
         self.players = {}
 
@@ -85,14 +776,35 @@ class Bot(commands.Bot):
         self.welcome_message = None
 
     def hook_db(self, path: str) -> Database:
-        """Hooks a database wrapper to the Bot instance"""
+        """Hooks a database wrapper to the Bot instance.
+           The connection pool is opened in the background once the loop is running.
+        """
         self.db = Database(path)
+        self.xp_ledger = XPLedger(self.db)
+        self.loop.create_task(self.db.open())
         return self.db
 
-    async def shutdown(self):
-        """Closes the bot's aiohttp session and logs out of Discord."""
+    async def close(self):
+        """Flushes cog write buffers, stops the render and extraction workers, closes the bot's
+           aiohttp session and database, and then the connection to Discord.
+           Runs on every way of stopping, including bot.run's teardown on SIGINT.
+        """
+        for cog in list(self.cogs.values()):
+            if (flush := getattr(cog, "cog_flush", None)):
+                try:
+                    await flush()
+                except Exception:  # pylint: disable=broad-except
+                    # keep closing, the other buffers shouldn't be lost too
+                    traceback.print_exc()
+
+        self.render_executor.shutdown()
+        if self.extraction_executor is not None:
+            self.extraction_executor.shutdown()
         await self.session.close()
-        await self.logout()
+        if self.db is not None:
+            await self.db.close()
+
+        await super().close()
 
 
 class ExtensionConverter(Converter):
@@ -152,8 +864,8 @@ class RankedUser:
     async def convert(cls, ctx: commands.Context, argument: str) -> "RankedUser":
         """Handles the conversion."""
         argument = argument.strip()
-        users = await ctx.bot.db.fetchall("SELECT * FROM levels ORDER BY xp DESC")
-        ids = [row["id"] for row in users]
+        ledger = ctx.bot.xp_ledger
+        await ledger.load()
 
         try:
             user = await GuaranteedUser().convert(ctx, argument)
@@ -164,31 +876,350 @@ class RankedUser:
             if argument.lower() == "first":
                 index = 0
             elif argument.lower() == "last":
-                index = len(users) - 1
+                index = len(ledger) - 1
             else:
                 index = int(argument.lstrip("# ")) - 1
 
-                if index >= len(users):
+                if index >= len(ledger):
                     raise BadArgument(f"Leaderboard index #{index + 1} out of range")
                 if index < 0:
                     raise BadArgument(f"Leaderboard index must be greater than 0.")
 
-            user_id = ids[index]
+            user_id = ledger.ranks.at(index)
 
             try:
                 user = await commands.UserConverter().convert(ctx, str(user_id))
             except BadArgument:
                 raise BadArgument(f"User \"{argument}\" not found")
 
-        data = await ctx.bot.db.fetchone("SELECT * FROM levels WHERE id = ?", user.id)
-        xp = data["xp"]
-        level = data["level"]
-        level_xp = data["level_xp"]
-        position = ids.index(user.id) + 1
+        if not (data := ledger.get(user.id)):
+            raise BadArgument(f"User \"{user}\" has no rank yet")
+
+        xp = data.xp
+        level = data.level
+        level_xp = data.level_xp
+        position = ledger.ranks.position(user.id) + 1
 
         return cls(user, xp, level, level_xp, position)
 
 
+class LRUCache:
+    """Mapping that holds at most maxsize items, dropping the least recently used first."""
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._data
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Gets an item and marks it as recently used."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        """Removes an item and returns it."""
+        return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        """Removes every item."""
+        self._data.clear()
+
+
+class AvatarCache:
+    """Avatar image bytes keyed by avatar hash.
+
+       Kept in memory, and also on disk if a directory is given. Since the hash changes
+       whenever the avatar does, entries never go stale, invalidate() just frees space.
+    """
+    def __init__(self, session: ClientSession, *, size: int = 256,
+                 maxsize: int = 256, directory: Optional[str] = None) -> None:
+        self.session = session
+        self.size = size
+        self.directory = directory
+        self.memory = LRUCache(maxsize)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> Optional[str]:
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, f"{key}-{self.size}.png")
+
+    @staticmethod
+    def _read_file(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        # write to a temporary file first so a crash can't leave a half written avatar
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    async def read(self, asset: Asset) -> bytes:
+        """Gets an avatar's bytes as a png, downloading it only if it isn't cached."""
+        if (data := self.memory.get(asset.key)) is not None:
+            return data
+
+        loop = asyncio.get_running_loop()
+        path = self._path(asset.key)
+
+        if not path or (data := await loop.run_in_executor(None, self._read_file, path)) is None:
+            url = asset.replace(size=self.size, format="png").url
+            async with self.session.get(url) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+
+            if path:
+                await loop.run_in_executor(None, self._write_file, path, data)
+
+        self.memory[asset.key] = data
+        return data
+
+    def invalidate(self, key: str) -> None:
+        """Drops an avatar from both tiers."""
+        self.memory.pop(key)
+
+        if (path := self._path(key)) and os.path.isfile(path):
+            os.remove(path)
+
+
+class EmbedDispatcher:
+    """Sends embeds to a channel in batches instead of one message each.
+
+       A batch goes out delay seconds after the first embed of it is queued, packing as
+       many embeds into each message as Discord allows. A batch that fails because of a
+       server or network error goes back to the front of the queue and is retried, up to
+       MAX_ATTEMPTS times. A batch Discord rejects is sent again one embed at a time, so
+       only the invalid embed is lost. When max_backlog embeds are already waiting, or an
+       embed is given up on, it's dropped and counted instead, and the next message
+       mentions how many were lost.
+    """
+    MAX_EMBEDS = 10
+    MAX_CHARACTERS = 6000
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, bot: "Bot", channel_id: int, *, delay: float = 2.0,
+                 max_backlog: int = 500) -> None:
+        self.bot = bot
+        self.channel_id = channel_id
+        self.delay = delay
+        self.max_backlog = max_backlog
+
+        self.sent = 0
+        self.messages = 0
+        self.dropped = 0
+        self._unreported_drops = 0
+        self._failures = 0
+
+        self.queue: Deque[Embed] = deque()
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = bot.loop.create_task(self._run())
+
+    def put(self, embed: Embed) -> bool:
+        """Queues an embed. Returns False if it was dropped because the backlog is full."""
+        if len(self.queue) >= self.max_backlog:
+            self.dropped += 1
+            self._unreported_drops += 1
+            return False
+
+        self.queue.append(embed)
+        self._wakeup.set()
+        return True
+
+    def _next_batch(self) -> List[Embed]:
+        batch = []
+        characters = 0
+
+        while self.queue and len(batch) < self.MAX_EMBEDS:
+            size = len(self.queue[0])
+            if batch and characters + size > self.MAX_CHARACTERS:
+                break
+
+            batch.append(self.queue.popleft())
+            characters += size
+
+        return batch
+
+    async def _send(self, content: Optional[str], batch: List[Embed]) -> None:
+        if (channel := self.bot.get_channel(self.channel_id)) is None:
+            raise LookupError(f"Channel {self.channel_id} is not available.")
+
+        await channel.send(content, embeds=batch)
+
+        self.sent += len(batch)
+        self.messages += 1
+
+    async def _send_each(self, content: Optional[str], batch: List[Embed]) -> bool:
+        """Sends a rejected batch one embed at a time, dropping the ones that fail.
+           Returns whether content went out with one of them.
+        """
+        for embed in batch:
+            try:
+                await self._send(content, [embed])
+            except (HTTPException, ClientError, OSError, asyncio.TimeoutError, LookupError):
+                traceback.print_exc()
+                self.dropped += 1
+                self._unreported_drops += 1
+            else:
+                content = None
+
+        return content is None
+
+    async def flush(self) -> None:
+        """Sends everything that's queued right away.
+           Every embed is either sent or counted as dropped by the time this returns.
+        """
+        async with self._lock:
+            while self.queue:
+                batch = self._next_batch()
+                drops, self._unreported_drops = self._unreported_drops, 0
+                content = None
+
+                if drops:
+                    entries = "log entry was" if drops == 1 else "log entries were"
+                    content = f"{drops} {entries} dropped after a full backlog or failed sends."
+
+                try:
+                    await self._send(content, batch)
+                except HTTPException as exc:
+                    traceback.print_exc()
+                    if exc.status < 500:
+                        # an embed in the batch is invalid, retrying the whole batch won't help
+                        self._failures = 0
+                        if not await self._send_each(content, batch):
+                            self._unreported_drops += drops
+                        continue
+                except (ClientError, OSError, asyncio.TimeoutError, LookupError):
+                    traceback.print_exc()
+                else:
+                    self._failures = 0
+                    continue
+
+                self._failures += 1
+
+                if self._failures < self.MAX_ATTEMPTS:
+                    # put it back in front so the log stays in order, then try again
+                    self.queue.extendleft(reversed(batch))
+                    self._unreported_drops += drops
+                    await asyncio.sleep(self.delay)
+                else:
+                    self._failures = 0
+                    self.dropped += len(batch)
+                    self._unreported_drops += drops + len(batch)
+
+    async def _run(self) -> None:
+        await self.bot.wait_until_ready()
+
+        while True:
+            await self._wakeup.wait()
+
+            # give a burst of events time to fill the batch unless it's full already
+            if len(self.queue) < self.MAX_EMBEDS:
+                await asyncio.sleep(self.delay)
+
+            try:
+                await self.flush()
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+
+            if not self.queue:
+                self._wakeup.clear()
+
+    def close(self) -> None:
+        """Stops the background task. Anything still queued is only sent by flush()."""
+        self._task.cancel()
+
+
+class ReactionRemover:
+    """Removes reactions through partial messages, so the message is never fetched.
+
+       The first removal on a message is sent right away. On messages where every
+       reaction goes anyway, anything queued while a request is in flight is merged into
+       a single clear_reactions. Elsewhere other members' reactions with the same emoji
+       may be wanted, so only the queued users' reactions are removed, one by one.
+    """
+    def __init__(self, bot: "Bot") -> None:
+        self.bot = bot
+
+        self.queued = 0
+        self.requests = 0
+
+        # message id -> (channel id, strip every reaction, emoji -> user ids)
+        self.pending: Dict[int, Tuple[int, bool, Dict[PartialEmoji, Set[int]]]] = {}
+        self._workers: Set[int] = set()
+
+    def remove(self, channel_id: int, message_id: int, emoji: PartialEmoji, user_id: int,
+               *, strip_all: bool = False) -> None:
+        """Queues a user's reaction for removal.
+           strip_all marks messages that aren't supposed to have any reactions at all.
+        """
+        self.queued += 1
+
+        _, was_strip_all, emojis = self.pending.get(message_id, (channel_id, strip_all, {}))
+        emojis.setdefault(emoji, set()).add(user_id)
+        self.pending[message_id] = channel_id, strip_all and was_strip_all, emojis
+
+        if message_id not in self._workers:
+            self._workers.add(message_id)
+            self.bot.loop.create_task(self._drain(message_id))
+
+    async def _drain(self, message_id: int) -> None:
+        try:
+            while (entry := self.pending.pop(message_id, None)):
+                channel_id, strip_all, emojis = entry
+                message = self.bot.get_channel(channel_id).get_partial_message(message_id)
+
+                if strip_all and (len(emojis) > 1 or any(len(u) > 1 for u in emojis.values())):
+                    calls = [message.clear_reactions()]
+                else:
+                    calls = [
+                        message.remove_reaction(emoji, Object(user_id))
+                        for emoji, users in emojis.items() for user_id in users
+                    ]
+
+                for call in calls:
+                    self.requests += 1
+                    try:
+                        await call
+                    except NotFound:
+                        # the message is gone, so are its reactions
+                        for leftover in calls:
+                            leftover.close()
+                        self.pending.pop(message_id, None)
+                        return
+                    except HTTPException:
+                        traceback.print_exc()
+        finally:
+            self._workers.discard(message_id)
+
+
 def slicer(item: Iterable, per: int) -> list:
     """Slices an iterable into parts, each part containing per items."""
     sliced = []
@@ -199,18 +1230,22 @@ def slicer(item: Iterable, per: int) -> list:
     return sliced
 
 
+# Frame delay for gifmap in hundredths of a second, and the palette index left transparent
+GIFMAP_FRAME_DELAY = 6
+GIF_TRANSPARENT_INDEX = 255
+
+
 def get_luminance(r, g, b, a=1) -> float:
     """Gets luminance from an RGB value.
        Source: https://github.com/CuteFwan/Koishi"""
     return (0.299 * r + 0.587 * g + 0.114 * b) * a
 
 
-def gifmap(im2, im1) -> io.BytesIO:
-    """Rearranges image 1's pixels to look like image 2.
-       Credit: https://github.com/CuteFwan/Koishi"""
-    im1 = Image.open(im1).resize((256, 256), resample=Image.LANCZOS)
-    im2 = Image.open(im2).resize((256, 256), resample=Image.LANCZOS)
+def _gifmap_multipliers() -> List[float]:
+    return [1 - (1 / (1 + (1.7 ** -multiplier))) for multiplier in range(-10, 11)]
+
 
+def _gifmap_frames_python(im2: Image.Image, im1: Image.Image) -> List[Image.Image]:
     im1data = im1.load()
     im1data = [[(x, y), im1data[x, y]] for x in range(256) for y in range(256)]
     im1data.sort(key=lambda c: get_luminance(*c[1]))
@@ -220,9 +1255,7 @@ def gifmap(im2, im1) -> io.BytesIO:
     im2data.sort(key=lambda c: get_luminance(*c[1]))
 
     frames = []
-    for multiplier in range(-10, 11):
-        m = 1 - (1 / (1 + (1.7 ** -multiplier)))
-
+    for m in _gifmap_multipliers():
         base = Image.new("RGBA", (256, 256))
         basedata = base.load()
         for i, d in enumerate(im1data):
@@ -232,6 +1265,147 @@ def gifmap(im2, im1) -> io.BytesIO:
             basedata[x, y] = im2data[i][1]
         frames.append(base)
 
+    return frames
+
+
+def _column_major(array: "np.ndarray") -> "np.ndarray":
+    # flattens an image array into the same x-major order the pure python version uses
+    return array.swapaxes(0, 1).reshape(-1, *array.shape[2:])
+
+
+def _sort_by_luminance(image: Image.Image) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Returns the stable luminance order of an image's pixels and their coordinates."""
+    channels = _column_major(np.asarray(image)).astype(np.float64)
+
+    luminance = 0.299 * channels[:, 0] + 0.587 * channels[:, 1] + 0.114 * channels[:, 2]
+    if channels.shape[1] == 4:
+        luminance = luminance * channels[:, 3]
+
+    # stable, so pixels with equal luminance keep the same relative order as before
+    order = np.argsort(luminance, kind="stable")
+    coordinates = np.stack(np.divmod(order, image.size[1]), axis=1).astype(np.float64)
+    return order, coordinates
+
+
+def _gifmap_palette(image: Image.Image) -> Tuple["np.ndarray", bytes]:
+    """Quantizes an image once, returning each pixel's palette index and the palette.
+       Index 255 is left free for transparency.
+    """
+    quantized = image.convert("RGB").quantize(255)
+    indices = np.asarray(quantized).copy()
+
+    if image.mode == "RGBA":
+        indices[np.asarray(image.getchannel("A")) < 128] = GIF_TRANSPARENT_INDEX
+
+    palette = bytes(quantized.getpalette()[:255 * 3]).ljust(256 * 3, b"\0")
+    return indices, palette
+
+
+def _skip_sub_blocks(data: bytes, position: int) -> int:
+    while data[position]:
+        position += data[position] + 1
+    return position + 1
+
+
+def _encode_gif_frame(frame: "np.ndarray", palette: bytes) -> Tuple[bytes, bytes]:
+    """LZW encodes a frame of palette indices with PIL.
+       Returns the file header (with the global palette) and the frame's image block.
+    """
+    image = Image.fromarray(frame, "P")
+    image.putpalette(palette)
+
+    buffer = io.BytesIO()
+    image.save(buffer, "gif", optimize=False, interlace=False)
+    data = buffer.getvalue()
+
+    # header, logical screen descriptor and global color table
+    position = 13
+    if data[10] & 0x80:
+        position += 3 << ((data[10] & 0x07) + 1)
+    header = data[:position]
+
+    # skip any extensions PIL wrote, the caller writes its own graphic control extensions
+    while data[position] == 0x21:
+        position = _skip_sub_blocks(data, position + 2)
+
+    # image descriptor, optional local color table, LZW minimum code size and the data
+    start = position
+    position += 10
+    if data[position - 1] & 0x80:
+        position += 3 << ((data[position - 1] & 0x07) + 1)
+    position = _skip_sub_blocks(data, position + 1)
+
+    return header, data[start:position]
+
+
+def _gifmap_stream(im2: Image.Image, im1: Image.Image) -> io.BytesIO:
+    """Writes the gifmap animation one frame at a time.
+
+       im2 is quantized once and frames are built straight from its palette indices,
+       so no frame is ever quantized on its own. Only the encoded frames are kept,
+       and the mirrored second half reuses them as they are.
+    """
+    order1, start = _sort_by_luminance(im1)
+    order2, end = _sort_by_luminance(im2)
+
+    indices, palette = _gifmap_palette(im2)
+    values = _column_major(indices)[order2]
+
+    delta = end - start
+    positions = np.arange(len(values))
+
+    # disposal 2 clears each frame before the next one, index 255 is transparent
+    control = bytes((0x21, 0xF9, 0x04, 0x09)) \
+        + GIFMAP_FRAME_DELAY.to_bytes(2, "little") + bytes((GIF_TRANSPARENT_INDEX, 0x00))
+
+    buffer = io.BytesIO()
+    blocks = []
+
+    for m in _gifmap_multipliers():
+        x, y = np.rint(start + delta * m).astype(np.intp).T
+        targets = y * 256 + x
+
+        # later pixels overwrite earlier ones that land on the same spot, fancy index
+        # assignment doesn't guarantee an order so find the last write to each spot first
+        last_write = np.full(256 * 256, -1, np.intp)
+        np.maximum.at(last_write, targets, positions)
+        written = last_write >= 0
+
+        frame = np.full(256 * 256, GIF_TRANSPARENT_INDEX, np.uint8)
+        frame[written] = values[last_write[written]]
+
+        header, block = _encode_gif_frame(frame.reshape(256, 256), palette)
+
+        if not blocks:
+            # loop forever
+            buffer.write(b"GIF89a" + header[6:])
+            buffer.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+        buffer.write(control + block)
+        blocks.append(block)
+
+    for block in reversed(blocks):
+        buffer.write(control + block)
+
+    buffer.write(b"\x3B")
+    buffer.seek(0)
+    return buffer
+
+
+def gifmap(im2, im1) -> io.BytesIO:
+    """Rearranges image 1's pixels to look like image 2.
+       Credit: https://github.com/CuteFwan/Koishi"""
+    im1 = Image.open(im1).resize((256, 256), resample=Image.LANCZOS)
+    im2 = Image.open(im2).resize((256, 256), resample=Image.LANCZOS)
+
+    # palette and greyscale images don't have per channel pixels to sort by
+    im1 = im1 if im1.mode in ("RGB", "RGBA") else im1.convert("RGBA")
+    im2 = im2 if im2.mode in ("RGB", "RGBA") else im2.convert("RGBA")
+
+    if np is not None:
+        return _gifmap_stream(im2, im1)
+
+    frames = _gifmap_frames_python(im2, im1)
     frames = frames + frames[::-1]
 
     b = io.BytesIO()
@@ -0,0 +1,38 @@
+"""Times CardRenderer.fit_name against the loop it replaced.
+
+   Run from the repo root: python -m tests.bench_fit_name
+"""
+import random
+import string
+import timeit
+
+from cogs import levels
+from tests.test_levels import fit_name_loop
+
+
+def main():
+    rng = random.Random(711)
+    names = ["".join(rng.choices(string.ascii_letters, k=32)) for _ in range(50)]
+
+    renderer = levels.CardRenderer()
+    # load every font size up front so both sides only measure the fitting
+    for size in range(levels.NAME_SMALLEST_SIZE, levels.NAME_LARGEST_SIZE + 1):
+        renderer.font(levels.BOLD_FONT, size)
+
+    loop = timeit.timeit(lambda: [fit_name_loop(renderer, n) for n in names], number=1)
+    cold = timeit.timeit(
+        lambda: [renderer._fit_name(n, levels.NAME_MAX_WIDTH) for n in names], number=1
+    )
+    for name in names:
+        renderer.fit_name(name, levels.NAME_MAX_WIDTH)
+    cached = timeit.timeit(
+        lambda: [renderer.fit_name(n, levels.NAME_MAX_WIDTH) for n in names], number=100
+    ) / 100
+
+    print(f"one point steps: {loop / len(names) * 1000:.2f} ms per name")
+    print(f"binary search:   {cold / len(names) * 1000:.2f} ms per name")
+    print(f"cache hit:       {cached / len(names) * 1e6:.2f} us per name")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Times gifmap against the pure Python frame loop it replaced.
+
+   Run from the repo root: python -m tests.bench_gifmap
+"""
+import io
+import timeit
+
+from cogs.utils import utils
+from tests.test_gifmap import SOURCE, TARGET, load
+
+
+def python_gifmap() -> io.BytesIO:
+    frames = utils._gifmap_frames_python(load(TARGET), load(SOURCE))
+    frames = frames + frames[::-1]
+
+    buffer = io.BytesIO()
+    frames[0].save(buffer, "gif", save_all=True, append_images=frames[1:], loop=0, duration=60)
+    return buffer
+
+
+def main():
+    loop = timeit.timeit(python_gifmap, number=1)
+    vectorized = timeit.timeit(lambda: utils.gifmap(TARGET, SOURCE), number=5) / 5
+
+    print(f"python loop: {loop * 1000:.0f} ms")
+    print(f"numpy:       {vectorized * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
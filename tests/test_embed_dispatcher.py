@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+
+from cogs.utils import utils
+
+
+def http_error(status):
+    return discord.HTTPException(SimpleNamespace(status=status, reason="error"), "error")
+
+
+class FakeEmbed:
+    def __init__(self, valid=True):
+        self.valid = valid
+
+    def __len__(self):
+        return 100
+
+
+class FakeChannel:
+    """Rejects messages with an invalid embed, and fails with a 500 when told to."""
+    def __init__(self, server_errors=0):
+        self.server_errors = server_errors
+        self.messages = []
+
+    async def send(self, content=None, embeds=None):
+        if self.server_errors:
+            self.server_errors -= 1
+            raise http_error(500)
+        if not all(embed.valid for embed in embeds):
+            raise http_error(400)
+        self.messages.append((content, embeds))
+
+
+def flush(channel, embeds):
+    async def run():
+        bot = SimpleNamespace(loop=asyncio.get_running_loop(), get_channel=lambda i: channel)
+        dispatcher = utils.EmbedDispatcher(bot, 1, delay=0)
+        dispatcher.close()
+
+        for embed in embeds:
+            dispatcher.put(embed)
+        await dispatcher.flush()
+        return dispatcher
+
+    return asyncio.run(run())
+
+
+def test_server_errors_are_retried():
+    channel = FakeChannel(server_errors=2)
+    dispatcher = flush(channel, [FakeEmbed() for _ in range(10)])
+
+    assert dispatcher.sent == 10
+    assert dispatcher.dropped == 0
+
+
+def test_rejected_batch_only_loses_the_invalid_embed():
+    embeds = [FakeEmbed() for _ in range(10)]
+    embeds[3] = FakeEmbed(valid=False)
+    channel = FakeChannel()
+    dispatcher = flush(channel, embeds)
+
+    assert dispatcher.sent == 9
+    assert dispatcher.dropped == 1
+    assert [m[1][0] for m in channel.messages] == embeds[:3] + embeds[4:]
+
+
+def test_batch_is_dropped_after_repeated_server_errors():
+    channel = FakeChannel(server_errors=utils.EmbedDispatcher.MAX_ATTEMPTS)
+    dispatcher = flush(channel, [FakeEmbed() for _ in range(10)] + [FakeEmbed()])
+
+    assert dispatcher.dropped == 10
+    assert dispatcher.sent == 1
+    # the next message says what was lost
+    assert channel.messages[0][0].startswith("10 log entries were dropped")
@@ -0,0 +1,137 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from cogs import events
+from cogs.utils import utils
+
+GUILD_ID = utils.CEAPA_COOL_ID
+CHANNEL_ID = 662438467204153000
+MESSAGE_ID = 900000000000000001
+AUTHOR_ID = 200000000000000002
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.embeds = []
+
+    def put(self, embed):
+        self.embeds.append(embed)
+        return True
+
+
+def make_member(bot=False):
+    return SimpleNamespace(
+        id=AUTHOR_ID, bot=bot, mention=f"<@{AUTHOR_ID}>",
+        display_avatar=SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png")
+    )
+
+
+def make_cog(tmp_path, member):
+    guild = SimpleNamespace(
+        id=GUILD_ID, get_member=lambda user_id: member if user_id == AUTHOR_ID else None
+    )
+    channel = SimpleNamespace(id=CHANNEL_ID, mention=f"<#{CHANNEL_ID}>")
+    bot = SimpleNamespace(get_guild=lambda guild_id: guild, get_channel=lambda channel_id: channel)
+
+    cog = events.Events.__new__(events.Events)
+    cog.bot = bot
+    cog.mod_log = FakeDispatcher()
+    cog.message_store = utils.MessageStore(utils.Database(str(tmp_path / "test.db")))
+    return cog
+
+
+def raw_edit(**data):
+    """A RawMessageUpdateEvent for an uncached message, data typed like the gateway sends it."""
+    data = {"id": str(MESSAGE_ID), "channel_id": str(CHANNEL_ID), "guild_id": str(GUILD_ID), **data}
+    return SimpleNamespace(
+        message_id=MESSAGE_ID, channel_id=CHANNEL_ID, guild_id=GUILD_ID,
+        cached_message=None, data=data
+    )
+
+
+def run_edit(cog, payload):
+    async def run():
+        await cog.message_store.db.open()
+        await cog.message_store.setup()
+        try:
+            await events.Events.on_raw_message_edit(cog, payload)
+        finally:
+            await cog.message_store.db.close()
+
+    asyncio.run(run())
+
+
+def field_values(embed):
+    return {field.name: field.value for field in embed.fields}
+
+
+def test_uncached_edit_logs_stored_content(tmp_path):
+    cog = make_cog(tmp_path, make_member())
+    cog.message_store.add(MESSAGE_ID, CHANNEL_ID, AUTHOR_ID, "before")
+
+    run_edit(cog, raw_edit(author={"id": str(AUTHOR_ID)}, content="after", attachments=[]))
+
+    assert len(cog.mod_log.embeds) == 1
+    fields = field_values(cog.mod_log.embeds[0])
+    assert fields["Before"] == "before"
+    assert fields["After"] == "after"
+    assert cog.message_store.pending[MESSAGE_ID].content == "after"
+
+
+def test_long_edits_fit_in_fields(tmp_path):
+    cog = make_cog(tmp_path, make_member())
+    cog.message_store.add(MESSAGE_ID, CHANNEL_ID, AUTHOR_ID, "a" * 2000)
+
+    run_edit(cog, raw_edit(author={"id": str(AUTHOR_ID)}, content="b" * 2000))
+
+    fields = field_values(cog.mod_log.embeds[0])
+    assert fields["Before"] == "a" * 1020 + "..."
+    assert fields["After"] == "b" * 1020 + "..."
+    # the stored copy keeps the whole message
+    assert cog.message_store.pending[MESSAGE_ID].content == "b" * 2000
+
+
+def test_uncached_edit_without_stored_copy(tmp_path):
+    cog = make_cog(tmp_path, make_member())
+
+    run_edit(cog, raw_edit(author={"id": str(AUTHOR_ID)}, content="after"))
+
+    fields = field_values(cog.mod_log.embeds[0])
+    assert "Before" not in fields
+    assert fields["After"] == "after"
+
+
+def test_unchanged_content_is_not_logged(tmp_path):
+    cog = make_cog(tmp_path, make_member())
+    cog.message_store.add(MESSAGE_ID, CHANNEL_ID, AUTHOR_ID, "same")
+
+    run_edit(cog, raw_edit(author={"id": str(AUTHOR_ID)}, content="same"))
+
+    assert not cog.mod_log.embeds
+
+
+@pytest.mark.parametrize("data", [
+    # embed unfurl, only the embeds are sent
+    {"embeds": [{"type": "link", "url": "https://example.com"}]},
+    # author without content
+    {"author": {"id": str(AUTHOR_ID)}, "embeds": []},
+    # author who left the guild
+    {"author": {"id": "1"}, "content": "after"},
+])
+def test_partial_edits_are_ignored(tmp_path, data):
+    cog = make_cog(tmp_path, make_member())
+
+    run_edit(cog, raw_edit(**data))
+
+    assert not cog.mod_log.embeds
+    assert not cog.message_store.pending
+
+
+def test_bot_edits_are_ignored(tmp_path):
+    cog = make_cog(tmp_path, make_member(bot=True))
+
+    run_edit(cog, raw_edit(author={"id": str(AUTHOR_ID)}, content="after"))
+
+    assert not cog.mod_log.embeds
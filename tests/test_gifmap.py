@@ -0,0 +1,51 @@
+import pytest
+from PIL import Image, ImageSequence
+
+from cogs.utils import utils
+
+np = pytest.importorskip("numpy")
+
+# a photo-like template and a mostly flat one, so luminance ties get exercised too
+SOURCE = "./assets/images/DefaultBg.png"
+TARGET = "./assets/images/cumrat.png"
+
+
+def load(path: str) -> Image.Image:
+    image = Image.open(path).resize((256, 256), resample=Image.LANCZOS)
+    return image if image.mode in ("RGB", "RGBA") else image.convert("RGBA")
+
+
+@pytest.fixture(scope="module")
+def frames():
+    expected = utils._gifmap_frames_python(load(TARGET), load(SOURCE))
+    expected = expected + expected[::-1]
+
+    with Image.open(utils.gifmap(TARGET, SOURCE)) as gif:
+        actual = [frame.convert("RGBA") for frame in ImageSequence.Iterator(gif)]
+
+    return expected, actual
+
+
+def test_frame_count(frames):
+    expected, actual = frames
+    assert len(actual) == len(expected) == 42
+
+
+def test_transparency_matches(frames):
+    for expected, actual in zip(*frames):
+        expected_alpha = np.asarray(expected.getchannel("A")) >= 128
+        actual_alpha = np.asarray(actual.getchannel("A")) >= 128
+        assert np.array_equal(expected_alpha, actual_alpha)
+
+
+def test_colors_match_within_quantization(frames):
+    errors = []
+
+    for expected, actual in zip(*frames):
+        opaque = np.asarray(expected.getchannel("A")) >= 128
+        expected_rgb = np.asarray(expected.convert("RGB"), np.int16)[opaque]
+        actual_rgb = np.asarray(actual.convert("RGB"), np.int16)[opaque]
+        errors.append(np.abs(expected_rgb - actual_rgb).mean())
+
+    # the only difference is the 255 color palette both versions end up quantized to
+    assert max(errors) < 4
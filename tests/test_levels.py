@@ -0,0 +1,48 @@
+import pytest
+
+from cogs import levels
+
+NAMES = [
+    "egg",
+    "ValkyriaKing711",
+    "a" * 32,
+    "W" * 32,
+    "MMMMMMMMMMMMMMMMMMMMMMMMMMMMMMMM",
+    "\uff37\uff37\uff37\uff37\uff37\uff37\uff37\uff37\uff37\uff37\uff37\uff37",
+    "\u4f60\u597d\u4e16\u754c\u4f60\u597d\u4e16\u754c\u4f60\u597d\u4e16\u754c",
+    "i" * 32,
+    "___ --- ___ --- ___ --- ___ ---",
+]
+
+
+def fit_name_loop(renderer: levels.CardRenderer, name: str):
+    """The one point at a time loop fit_name replaced."""
+    size = levels.NAME_LARGEST_SIZE
+    n_font = renderer.font(levels.BOLD_FONT, size)
+
+    while (r_bound := n_font.getbbox(name, anchor="ls")[2]) > levels.NAME_MAX_WIDTH \
+          and size > levels.NAME_SMALLEST_SIZE:
+        size -= 1
+        n_font = renderer.font(levels.BOLD_FONT, size)
+
+    return size, r_bound
+
+
+@pytest.fixture(scope="module")
+def renderer():
+    return levels.CardRenderer()
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_fit_name_matches_loop(renderer, name):
+    assert renderer.fit_name(name, levels.NAME_MAX_WIDTH) == fit_name_loop(renderer, name)
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_name_width_grows_with_size(renderer, name):
+    # the binary search relies on this
+    widths = [
+        renderer.font(levels.BOLD_FONT, size).getbbox(name, anchor="ls")[2]
+        for size in range(levels.NAME_SMALLEST_SIZE, levels.NAME_LARGEST_SIZE + 1)
+    ]
+    assert widths == sorted(widths)
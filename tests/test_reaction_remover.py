@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+
+from cogs.utils import utils
+
+CHANNEL_ID = 797633928152088586
+MESSAGE_ID = 900000000000000001
+
+
+class FakePartialMessage:
+    def __init__(self, calls, message_id):
+        self.calls = calls
+        self.id = message_id
+
+    async def remove_reaction(self, emoji, member):
+        self.calls.append(("remove_reaction", emoji, member.id))
+        await asyncio.sleep(0.01)
+
+    async def clear_reaction(self, emoji):
+        self.calls.append(("clear_reaction", emoji))
+        await asyncio.sleep(0.01)
+
+    async def clear_reactions(self):
+        self.calls.append(("clear_reactions",))
+        await asyncio.sleep(0.01)
+
+
+def run_removals(removals, *, strip_all):
+    """Queues every removal at once, so all but the first are merged, and returns the calls."""
+    calls = []
+
+    async def run():
+        channel = SimpleNamespace(
+            get_partial_message=lambda message_id: FakePartialMessage(calls, message_id)
+        )
+        bot = SimpleNamespace(
+            loop=asyncio.get_running_loop(), get_channel=lambda channel_id: channel
+        )
+        remover = utils.ReactionRemover(bot)
+
+        for emoji, user_id in removals:
+            remover.remove(CHANNEL_ID, MESSAGE_ID, emoji, user_id, strip_all=strip_all)
+
+        while remover.pending or remover._workers:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    return calls
+
+
+def test_only_queued_users_are_removed():
+    # users 1, 2 and 3 reacted with the same emoji, only 2 and 3 are queued for removal
+    calls = run_removals([("\N{EGG}", 2), ("\N{EGG}", 3)], strip_all=False)
+
+    assert sorted(calls) == [
+        ("remove_reaction", "\N{EGG}", 2),
+        ("remove_reaction", "\N{EGG}", 3),
+    ]
+
+
+def test_strip_all_floods_are_cleared_at_once():
+    removals = [(emoji, user_id) for user_id in range(10) for emoji in ("\N{EGG}", "\N{COOKIE}")]
+    calls = run_removals(removals, strip_all=True)
+
+    assert calls == [("clear_reactions",)]
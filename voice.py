@@ -22,16 +22,26 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import asyncio
+import itertools
+import json
 import os
-from asyncio import AbstractEventLoop
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import TypeVar, Union
+from functools import partial
+from typing import Any, Callable, Deque, Dict, Hashable, Iterable, List, Optional, TypeVar, Union
+from urllib.parse import parse_qs, urlparse
 
 import discord
 from async_timeout import timeout
 from cogs.utils import utils
-from discord import (AudioSource, FFmpegPCMAudio, Guild, PCMVolumeTransformer,
-                     TextChannel)
+from discord import (AudioSource, FFmpegOpusAudio, FFmpegPCMAudio, Guild, Member,
+                     PCMVolumeTransformer, TextChannel)
 from discord.ext import commands, tasks
 from discord.ext.commands import Cog, Context
 from youtube_dl import YoutubeDL
@@ -45,10 +55,57 @@ FFMPEG_OPTIONS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
     "options": "-vn"
 }
+# Let FFmpeg produce Opus, copying Opus streams as is when the volume is untouched,
+# instead of decoding to PCM that gets scaled and encoded again in Python
+OPUS_MODE = True
+OPUS_BITRATE = 128
+# Length of the audio frames discord.py reads, in seconds
+FRAME_LENGTH = 0.02
+# The next track's FFmpeg process is spawned this many seconds before the current one ends
+HANDOFF_LEAD = 5
+# Seconds an idle player waits for something to be queued while people are still listening
+IDLE_TIMEOUT = 300
 
-ytdl = YoutubeDL({
+# Queue entries to resolve ahead of time while the current track plays
+PREFETCH_COUNT = 2
+# Stream urls that expire sooner than this many seconds get resolved again
+STREAM_URL_MARGIN = 60
+# Stream urls without an expire parameter are trusted for this many seconds
+STREAM_URL_TTL = 30 * 60
+# How long trimmed metadata and search results stay cached, in seconds
+METADATA_TTL = 7 * 24 * 60 * 60
+EXTRACTION_CACHE_SIZE = 1024
+# Threads dedicated to youtube_dl extraction
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "4"))
+# Most entries taken from a single playlist
+PLAYLIST_MAX_ENTRIES = 100
+DOWNLOAD_DIRECTORY = "downloads"
+# Downloads are kept after playback until they take up more than this
+DOWNLOAD_CACHE_BYTES = int(os.getenv("DOWNLOAD_CACHE_MB", "2048")) * 1024 * 1024
+# Keys that are either large or only valid together with a single stream url
+VOLATILE_KEYS = frozenset((
+    "formats", "requested_formats", "http_headers", "downloader_options", "thumbnails",
+    "subtitles", "automatic_captions", "requested_subtitles", "url"
+))
+URL_REGEX = re.compile(r"https?://(?:www\.)?.+")
+
+EXTRACTION_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ytdl_queries (
+    query TEXT PRIMARY KEY,
+    webpage_url TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ytdl_info (
+    webpage_url TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+"""
+
+YTDL_OPTIONS = {
     "format": "bestaudio/best",
-    "outtmpl": "downloads/%(autonumber)s-%(extractor)s-%(id)s-%(title)s.%(ext)s",
+    # one file per video so the download cache can find it again
+    "outtmpl": f"{DOWNLOAD_DIRECTORY}/%(extractor)s-%(id)s.%(ext)s",
     "restrictfilenames": True,
     "noplaylist": True,
     "nocheckcertificate": True,
@@ -61,99 +118,840 @@ ytdl = YoutubeDL({
     "source_address": "0.0.0.0",
     "geo_bypass_country": "FI",
     "age_limit": 30
+}
+
+ytdl = YoutubeDL(YTDL_OPTIONS)
+# Only lists a playlist's entries without extracting each of them
+flat_ytdl = YoutubeDL({
+    **YTDL_OPTIONS,
+    "noplaylist": False,
+    "extract_flat": "in_playlist",
+    "playlistend": PLAYLIST_MAX_ENTRIES
 })
 
 
-class YTDLSource(PCMVolumeTransformer):
-    def __init__(self, source: AudioSource, *,
-                 data: dict, volume=1.0):
-        super().__init__(source, volume)
+def stream_url_expiry(url: str) -> Optional[float]:
+    """Gets the unix time a signed stream url expires at, if it has one."""
+    if not (expire := parse_qs(urlparse(url).query).get("expire")):
+        return None
+
+    try:
+        return float(expire[0])
+    except ValueError:
+        return None
+
+
+def stream_url_expired(data: dict, *, margin: int = STREAM_URL_MARGIN) -> bool:
+    """Whether a resolved stream url is missing or about to expire.
+       Urls without an expire parameter are assumed to be valid.
+    """
+    if not (url := data.get("url")):
+        return True
+
+    if (expiry := stream_url_expiry(url)) is None:
+        return False
+
+    return expiry - time.time() < margin
+
+
+def normalize_query(query: str) -> str:
+    """Collapses whitespace, and case too unless the query is an url."""
+    query = " ".join(query.split())
+    return query if URL_REGEX.match(query) else query.lower()
+
+
+def trim_info(data: dict) -> dict:
+    """Copies extracted info without the keys that are large or expire."""
+    return {key: value for key, value in data.items() if key not in VOLATILE_KEYS}
+
+
+class ExtractionCache:
+    """Cache of youtube_dl extraction results.
+
+       Queries map to webpage urls, webpage urls map to trimmed metadata, and both are
+       kept for METADATA_TTL. Stream urls are kept separately until they expire.
+       Everything is held in bounded LRU caches, and queries and metadata are also
+       written to SQLite once a database is attached. Rows past METADATA_TTL are deleted
+       when attaching and by prune().
+    """
+    def __init__(self, maxsize: int = EXTRACTION_CACHE_SIZE) -> None:
+        self.queries = utils.LRUCache(maxsize)  # query -> (webpage url, stored at)
+        self.info = utils.LRUCache(maxsize)  # webpage url -> (trimmed info, stored at)
+        self.streams = utils.LRUCache(maxsize)  # webpage url -> (stream url, expires at)
+        self.db: Optional[utils.Database] = None
+
+    async def attach(self, db: utils.Database) -> None:
+        """Creates the cache tables and starts reading from and writing to them."""
+        await db.executescript(EXTRACTION_CACHE_SCHEMA)
+        self.db = db
+        await self.prune()
+
+    async def prune(self) -> None:
+        """Deletes stored queries and metadata that are too old to be used."""
+        if self.db is None:
+            return
+
+        cutoff = time.time() - METADATA_TTL
+        await self.db.execute("DELETE FROM ytdl_queries WHERE stored_at < ?", cutoff)
+        await self.db.execute("DELETE FROM ytdl_info WHERE stored_at < ?", cutoff)
+
+    @staticmethod
+    def _fresh(stored_at: float) -> bool:
+        return time.time() - stored_at < METADATA_TTL
+
+    async def _webpage_url(self, query: str) -> Optional[str]:
+        if (entry := self.queries.get(query)) is None and self.db is not None:
+            row = await self.db.fetchone(
+                "SELECT webpage_url, stored_at FROM ytdl_queries WHERE query = ?", query
+            )
+            if row:
+                self.queries[query] = entry = (row[0], row[1])
+
+        if entry is None or not self._fresh(entry[1]):
+            return None
+        return entry[0]
+
+    async def _info(self, webpage_url: str) -> Optional[dict]:
+        if (entry := self.info.get(webpage_url)) is None and self.db is not None:
+            row = await self.db.fetchone(
+                "SELECT info, stored_at FROM ytdl_info WHERE webpage_url = ?", webpage_url
+            )
+            if row:
+                self.info[webpage_url] = entry = (json.loads(row[0]), row[1])
+
+        if entry is None or not self._fresh(entry[1]):
+            return None
+        return entry[0]
+
+    def stream_url(self, webpage_url: str) -> Optional[str]:
+        """Gets a cached stream url that is still valid for a while."""
+        if (entry := self.streams.get(webpage_url)) is None:
+            return None
+
+        url, expires_at = entry
+        if expires_at - time.time() < STREAM_URL_MARGIN:
+            self.streams.pop(webpage_url)
+            return None
+        return url
+
+    async def lookup(self, query: str) -> Optional[dict]:
+        """Gets a copy of the cached info for a query or webpage url.
+           It has a "url" key only if a valid stream url is cached as well.
+        """
+        if (webpage_url := await self._webpage_url(normalize_query(query))) is None:
+            return None
+
+        if (info := await self._info(webpage_url)) is None:
+            return None
+
+        data = dict(info)
+        if (url := self.stream_url(webpage_url)):
+            data["url"] = url
+        return data
+
+    def store(self, query: Optional[str], data: dict) -> None:
+        """Caches freshly extracted info, under the query that produced it if given."""
+        webpage_url = data["webpage_url"]
+        now = time.time()
+        info = trim_info(data)
+        queries = {normalize_query(webpage_url)}
+
+        if query is not None:
+            queries.add(normalize_query(query))
+
+        for key in queries:
+            self.queries[key] = (webpage_url, now)
+        self.info[webpage_url] = (info, now)
+
+        if (url := data.get("url")):
+            self.streams[webpage_url] = (url, stream_url_expiry(url) or now + STREAM_URL_TTL)
+
+        if self.db is not None:
+            asyncio.get_running_loop().create_task(
+                self._persist([(key, webpage_url, now) for key in queries], webpage_url, info, now)
+            )
+
+    async def _persist(self, queries: list, webpage_url: str, info: dict, now: float) -> None:
+        try:
+            await self.db.executemany(
+                "INSERT OR REPLACE INTO ytdl_queries VALUES (?, ?, ?)", queries
+            )
+            await self.db.execute(
+                "INSERT OR REPLACE INTO ytdl_info VALUES (?, ?, ?)",
+                webpage_url, json.dumps(info, default=str), now
+            )
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+
+
+extraction_cache = ExtractionCache()
+
+
+class ExtractionExecutor:
+    """Thread pool for youtube_dl extraction.
+
+       Identical jobs that are running at the same time share one result, and when every
+       worker is busy, waiting jobs are started one guild at a time in round robin order
+       so a guild queuing a lot at once can't hold up everyone else.
+    """
+    def __init__(self, workers: int = EXTRACTION_WORKERS) -> None:
+        self.workers = workers
+        self.coalesced = 0
+
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="extraction")
+        self._free = workers
+        # guild id -> jobs waiting for a worker, in round robin order
+        self._waiting: "OrderedDict[Optional[int], Deque[asyncio.Future]]" = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def queue_depth(self) -> int:
+        """Amount of jobs waiting for a worker."""
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    async def _acquire(self, guild_id: Optional[int]) -> None:
+        if self._free and not self._waiting:
+            self._free -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(guild_id, deque()).append(waiter)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # got a worker right as we were cancelled, pass it on
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiting:
+            guild_id, waiters = next(iter(self._waiting.items()))
+            waiter = waiters.popleft()
+
+            if waiters:
+                self._waiting.move_to_end(guild_id)
+            else:
+                del self._waiting[guild_id]
+
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self._free += 1
+
+    async def _run(self, guild_id: Optional[int], func: Callable[[], Any]) -> Any:
+        await self._acquire(guild_id)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, func)
+        finally:
+            self._release()
+
+    async def run(self, func: Callable[[], Any], *, guild_id: Optional[int] = None,
+                  key: Optional[Hashable] = None) -> Any:
+        """Runs func in a worker thread. Jobs with the same key share a single run."""
+        if key is None:
+            return await self._run(guild_id, func)
+
+        if (future := self._in_flight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.ensure_future(self._run(guild_id, func))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # shielded so one caller being cancelled doesn't cancel it for the others
+        return await asyncio.shield(future)
+
+    def shutdown(self) -> None:
+        """Stops the worker threads once their current jobs finish."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+extraction_executor = ExtractionExecutor()
+
+
+async def extract(query: str, *, download: bool = False,
+                  guild_id: Optional[int] = None) -> dict:
+    """Extracts info for a query in the extraction executor.
+       Search results are unwrapped, and the returned dict is always the caller's own copy.
+    """
+    key = (normalize_query(query), download)
+    data = await extraction_executor.run(
+        partial(ytdl.extract_info, query, download=download), guild_id=guild_id, key=key
+    )
+
+    if "entries" in data:
+        data = data["entries"][0]
+
+    return dict(data)
+
+
+async def extract_flat(url: str, *, guild_id: Optional[int] = None) -> dict:
+    """Extracts a playlist's entry list without resolving the entries themselves.
+       The returned dict is shared with other callers and mustn't be modified.
+    """
+    return await extraction_executor.run(
+        partial(flat_ytdl.extract_info, url, download=False),
+        guild_id=guild_id, key=("flat", normalize_query(url))
+    )
+
+
+def flat_entry(entry: dict, *, ctx: Context = None) -> Optional["Track"]:
+    """Turns a flat playlist entry into an unresolved track, if it has an usable url."""
+    url = entry.get("webpage_url") or entry.get("url")
+
+    if not url:
+        return None
+
+    if not URL_REGEX.match(url):
+        if entry.get("ie_key") != "Youtube":
+            return None
+        url = f"https://www.youtube.com/watch?v={url}"
+
+    track = Track.from_info({**entry, "webpage_url": url}, ctx=ctx)
+    track.url = None
+    return track
+
+
+@dataclass
+class DownloadEntry:
+    """A file in the download cache."""
+    size: int
+    refs: int = 0
+
+
+class DownloadCache:
+    """Downloaded files, kept after playback until space is needed.
+
+       Files are named after their extractor and id, so a track is only ever downloaded
+       once. Sources hold a reference to their file from creation until playback ends,
+       and only files nobody references are evicted, least recently used first.
+    """
+    def __init__(self, directory: str = DOWNLOAD_DIRECTORY,
+                 max_bytes: int = DOWNLOAD_CACHE_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.files: "OrderedDict[str, DownloadEntry]" = OrderedDict()
+        self._scan()
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    @property
+    def in_use(self) -> int:
+        """Amount of files referenced by a queued or playing source."""
+        return sum(1 for entry in self.files.values() if entry.refs)
+
+    def _scan(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        # unfinished downloads are left for youtube_dl to resume
+        found = [
+            entry for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.endswith((".part", ".ytdl"))
+        ]
+
+        for entry in sorted(found, key=lambda entry: entry.stat().st_mtime):
+            size = entry.stat().st_size
+            self.files[os.path.join(self.directory, entry.name)] = DownloadEntry(size)
+            self.size += size
+
+        self.evict()
+
+    def acquire(self, path: str) -> bool:
+        """References an already downloaded file. Returns False if it isn't cached."""
+        if (entry := self.files.get(path)) is None:
+            return False
+
+        if not os.path.isfile(path):
+            self.size -= entry.size
+            del self.files[path]
+            return False
+
+        self.hits += 1
+        entry.refs += 1
+        self.files.move_to_end(path)
+        return True
+
+    def add(self, path: str) -> None:
+        """References a freshly downloaded file."""
+        self.misses += 1
+
+        if (entry := self.files.get(path)) is None:
+            entry = self.files[path] = DownloadEntry(os.path.getsize(path))
+            self.size += entry.size
+
+        entry.refs += 1
+        self.files.move_to_end(path)
+        self.evict()
+
+    def release(self, path: str) -> None:
+        """Drops a reference taken with acquire() or add()."""
+        if (entry := self.files.get(path)) is not None:
+            entry.refs = max(0, entry.refs - 1)
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes unreferenced files until the cache fits in max_bytes."""
+        if self.size <= self.max_bytes:
+            return
+
+        for path, entry in list(self.files.items()):
+            if self.size <= self.max_bytes:
+                break
+            if entry.refs:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.size -= entry.size
+            self.evictions += 1
+            del self.files[path]
+
+
+download_cache = DownloadCache()
+
+
+class Track:
+    """What the player and its embeds need to know about a track.
 
-        self.data = data
+       Only the requester's and channel's ids are kept, so queued tracks don't hold on to
+       Context objects. url is the stream url, which stays None until the track is resolved.
+    """
+    __slots__ = (
+        "title", "url", "webpage_url", "duration", "uploader", "thumbnail", "is_live",
+        "requester_id", "channel_id", "start"
+    )
 
-        self.title = data.get("title")
+    # saved in player snapshots, the stream url expires and start is saved separately
+    SNAPSHOT_FIELDS = (
+        "title", "webpage_url", "duration", "uploader", "thumbnail", "is_live",
+        "requester_id", "channel_id"
+    )
+
+    def __init__(self, *, title: str, webpage_url: str, url: Optional[str] = None,
+                 duration: Optional[float] = None, uploader: Optional[str] = None,
+                 thumbnail: Optional[str] = None, is_live: bool = False,
+                 requester_id: Optional[int] = None, channel_id: Optional[int] = None,
+                 start: float = 0.0):
+        self.title = title
+        self.url = url
+        self.webpage_url = webpage_url
+        self.duration = duration
+        self.uploader = uploader
+        self.thumbnail = thumbnail
+        self.is_live = is_live
+        self.requester_id = requester_id
+        self.channel_id = channel_id
+        # position to start playing from, set for tracks restored from a snapshot
+        self.start = start
+
+    def __repr__(self) -> str:
+        return f"<Track title={self.title!r} webpage_url={self.webpage_url!r}>"
+
+    @classmethod
+    def from_info(cls, data: dict, *, ctx: Context = None) -> "Track":
+        """Creates a track from extracted info."""
+        track = cls(title=data.get("title") or data["webpage_url"], webpage_url=data["webpage_url"])
+        track.update(data)
+
+        if ctx:
+            track.requester_id = ctx.author.id
+            track.channel_id = ctx.channel.id
+
+        return track
+
+    def update(self, data: dict):
+        """Takes the stream url and any metadata the track is missing from extracted info."""
         self.url = data.get("url")
+        self.is_live = bool(data.get("is_live"))
+
+        for field in ("title", "duration", "uploader", "thumbnail"):
+            if (value := data.get(field)) is not None:
+                setattr(self, field, value)
 
+    def to_json(self) -> dict:
+        """Gets the track as a dict for a player snapshot."""
+        return {field: getattr(self, field) for field in self.SNAPSHOT_FIELDS}
+
+    @classmethod
+    def from_json(cls, data: dict, *, start: float = 0.0) -> "Track":
+        """Creates a track from a dict made by to_json."""
+        return cls(**data, start=start)
+
+
+class PlayerQueue(asyncio.Queue):
+    """asyncio.Queue that can look at upcoming entries without taking them."""
+    def peek(self, amount: Optional[int]) -> list:
+        return list(itertools.islice(self._queue, amount))
+
+
+class YTDLSource(AudioSource):
+    """Plays an extracted track through FFmpeg.
+
+       FFmpeg is only spawned once the source is started or first read. In Opus mode the
+       volume is applied by FFmpeg, so changing it respawns FFmpeg at the current position.
+    """
+    def __init__(self, source: str, *, track: Track, codec: Optional[str] = None,
+                 filename: Optional[str] = None, volume: float = 1.0, stream: bool = True):
+        self.track = track
+
+        self.title = track.title
+        self.url = track.url
+
+        self.input = source
+        self.codec = codec
+        self.filename = filename
+        self.stream = stream
+        self.opus = OPUS_MODE
+        self.frames = round(track.start / FRAME_LENGTH)
+
+        self._volume = max(volume, 0.0)
+        self._original: Optional[AudioSource] = None
+        # held while reading so the FFmpeg process can't be swapped out mid-frame
+        self._lock = threading.Lock()
+
+    @property
+    def position(self) -> float:
+        """Playback position in seconds."""
+        return self.frames * FRAME_LENGTH
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        value = max(value, 0.0)
+        if value == self._volume:
+            return
+
+        self._volume = value
+
+        if self._original is None:
+            return
+
+        if self.opus:
+            self._restart()
+        else:
+            self._original.volume = value
+
+    def _spawn(self) -> AudioSource:
+        before_options = FFMPEG_OPTIONS["before_options"] if self.stream else ""
+
+        if self.frames and not self.track.is_live:
+            before_options = f"{before_options} -ss {self.position:.2f}".lstrip()
+
+        if not self.opus:
+            return PCMVolumeTransformer(
+                FFmpegPCMAudio(
+                    self.input, before_options=before_options, options=FFMPEG_OPTIONS["options"]
+                ),
+                self._volume
+            )
+
+        options = FFMPEG_OPTIONS["options"]
+        codec = self.codec
+
+        if self._volume != 1.0:
+            # filtering means the audio has to be encoded again anyway
+            options = f"{options} -filter:a volume={self._volume:.2f}"
+            codec = None
+
+        return FFmpegOpusAudio(
+            self.input, bitrate=OPUS_BITRATE, codec=codec,
+            before_options=before_options, options=options
+        )
+
+    def _restart(self):
+        new = self._spawn()
+
+        with self._lock:
+            old, self._original = self._original, new
+
+        if old is not None:
+            old.cleanup()
+
+    def start(self):
+        """Spawns FFmpeg now instead of on the first read."""
+        with self._lock:
+            if self._original is None:
+                self._original = self._spawn()
+
+    def read(self) -> bytes:
+        with self._lock:
+            if self._original is None:
+                self._original = self._spawn()
+            data = self._original.read()
+
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+    def cleanup(self):
+        with self._lock:
+            original, self._original = self._original, None
+
+        if original is not None:
+            original.cleanup()
+
+    @classmethod
+    async def create(cls, source: str, *, track: Track, data: dict,
+                     filename: Optional[str] = None, stream: bool = True) -> Y:
+        """Creates a source, probing the codec first if the extracted info doesn't have it."""
+        codec = data.get("acodec")
+
+        if OPUS_MODE and codec in (None, "none"):
+            try:
+                codec, _ = await FFmpegOpusAudio.probe(source)
+            except Exception:  # pylint: disable=broad-except
+                codec = None
+
+        return cls(source, track=track, codec=codec, filename=filename, stream=stream)
 
     @classmethod
     async def from_query(cls, query: str, *,
-                         loop: AbstractEventLoop = None,
                          stream: bool = True, partial: bool = False,
-                         ctx: Context = None) -> Union[dict, Y]:
+                         ctx: Context = None) -> Union[Track, Y]:
         if not stream and partial:
             raise ValueError("partial cannot be True when not streaming")
 
-        loop = loop or asyncio.get_running_loop()
-        data = await loop.run_in_executor(
-            None,
-            lambda: ytdl.extract_info(query, download=not stream)
-        )
+        cached = await extraction_cache.lookup(query)
 
-        if "entries" in data:
-            data = data["entries"][0]
+        if not stream and cached and download_cache.acquire(ytdl.prepare_filename(cached)):
+            data = cached
+        elif cached and (partial or stream and "url" in cached):
+            data = cached
+        else:
+            # a cached webpage url skips the search even if the info has to be extracted again
+            data = await extract(
+                cached["webpage_url"] if cached else query,
+                download=not stream,
+                guild_id=ctx.guild.id if ctx and ctx.guild else None
+            )
+            extraction_cache.store(query, data)
 
-        if ctx:
-            data["context"] = ctx
+            if not stream:
+                download_cache.add(ytdl.prepare_filename(data))
 
-        if partial:
-            for key in ("formats", "http_headers", "downloader_options", "thumbnails", "url"):
-                try:
-                    del data[key]
-                except Exception:
-                    pass
-            return data
+        track = Track.from_info(data, ctx=ctx)
 
-        options = FFMPEG_OPTIONS.copy()
+        if partial:
+            track.url = None
+            return track
 
         if stream:
-            source = data["url"]
-        else:
-            source = ytdl.prepare_filename(data)
-            data["filename"] = source
-            options.pop("before_options")
+            return await cls.create(data["url"], track=track, data=data)
 
-        return cls(FFmpegPCMAudio(source, **options), data=data)
+        filename = ytdl.prepare_filename(data)
+        return await cls.create(filename, track=track, data=data, filename=filename, stream=False)
 
-    @classmethod
-    async def regather_stream(cls, data: dict, *,
-                              loop: AbstractEventLoop = None) -> Y:
-        loop = loop or asyncio.get_running_loop()
-        ctx = data.get("context")
-        data = await loop.run_in_executor(
-            None,
-            lambda: ytdl.extract_info(data["webpage_url"], download=False)
-        )
+    @staticmethod
+    async def from_playlist(url: str, *, ctx: Context = None) -> List[Track]:
+        """Gets unresolved tracks for everything in a playlist.
+           An url to a single track gives just that track.
+        """
+        data = await extract_flat(url, guild_id=ctx.guild.id if ctx and ctx.guild else None)
 
-        if ctx:
-            data["context"] = ctx
+        if "entries" not in data:
+            extraction_cache.store(url, data)
+            track = Track.from_info(data, ctx=ctx)
+            track.url = None
+            return [track]
+
+        entries = itertools.islice(data["entries"], PLAYLIST_MAX_ENTRIES)
+        return [track for entry in entries if (track := flat_entry(entry, ctx=ctx))]
+
+    @staticmethod
+    async def resolve(track: Track, *, guild_id: Optional[int] = None) -> dict:
+        """Gets a track's full info, including a stream url, from the cache or youtube_dl."""
+        if (cached := await extraction_cache.lookup(track.webpage_url)) and "url" in cached:
+            return cached
 
-        return cls(FFmpegPCMAudio(data["url"]), data=data)
+        data = await extract(track.webpage_url, guild_id=guild_id)
+        extraction_cache.store(None, data)
+        return data
+
+    @classmethod
+    async def from_resolved(cls, track: Track, data: dict) -> Y:
+        """Creates a source for a track from info that has a valid stream url."""
+        track.update(data)
+        return await cls.create(data["url"], track=track, data=data)
+
+    @classmethod
+    async def regather_stream(cls, track: Track, *, guild_id: Optional[int] = None) -> Y:
+        return await cls.from_resolved(track, await cls.resolve(track, guild_id=guild_id))
 
 
 class MusicPlayer:
-    def __init__(self, ctx: Context):
-        self.bot: utils.Bot = ctx.bot
-        self._channel: TextChannel = ctx.channel
-        self._cog: Cog = ctx.cog
-        self._guild: Guild = ctx.guild
+    def __init__(self, bot: utils.Bot, cog: Cog, guild: Guild, channel: TextChannel):
+        self.bot = bot
+        self._channel = channel
+        self._cog = cog
+        self._guild = guild
 
         self.next = asyncio.Event()
-        self.queue = asyncio.Queue()
+        self.queue = PlayerQueue()
 
-        self.current = None
+        # id of an unresolved queued track -> task resolving its stream info
+        self._prefetches: Dict[int, asyncio.Task] = {}
+        # id of an unresolved queued track -> source already started for a gapless handoff
+        self._prepared: Dict[int, YTDLSource] = {}
+
+        self.current: Optional[YTDLSource] = None
         self.volume = 1.0
 
-        self.first_play_id = None
-        self.skipped = None
+        # the play command already announces the track it starts playing
+        self.first_play: Optional[Track] = None
+        self.skipped: Optional[YTDLSource] = None
+        self.skipper: Optional[Member] = None
 
         self.player_loop.start()  # pylint: disable=no-member
 
+    @property
+    def idle(self) -> bool:
+        """Whether nothing is playing or queued."""
+        return self.current is None and self.queue.empty()
+
+    def requester(self, track: Track) -> Optional[Member]:
+        """Gets the member who queued a track, if they're still around."""
+        if track.requester_id is None:
+            return None
+        return self._guild.get_member(track.requester_id)
+
+    def snapshot(self) -> Optional[tuple]:
+        """Gets the player's state as a row for the music_players table,
+           or None if it isn't connected to a voice channel.
+        """
+        if (vc := self._guild.voice_client) is None:
+            return None
+
+        # the first source played can be both current and still queued
+        entries = {id(entry): entry for entry in (self.current, *self.queue.peek(None)) if entry}
+        tracks = [
+            entry.track if isinstance(entry, YTDLSource) else entry for entry in entries.values()
+        ]
+
+        if self.current:
+            position = self.current.position
+        else:
+            position = tracks[0].start if tracks else 0.0
+
+        queue = [track.to_json() for track in tracks]
+
+        return (
+            self._guild.id, vc.channel.id, self._channel.id, self.volume, round(position, 2),
+            json.dumps(queue, separators=(",", ":"))
+        )
+
+    def has_listeners(self) -> bool:
+        """Whether anyone other than bots is in the player's voice channel."""
+        if (vc := self._guild.voice_client) is None:
+            return False
+        return any(not member.bot for member in vc.channel.members)
+
+    async def enqueue(self, entry: Union[Track, YTDLSource]):
+        """Adds a source or an unresolved track to the queue and starts resolving upcoming ones."""
+        await self.queue.put(entry)
+        self.prefetch()
+
+    def enqueue_many(self, entries: Iterable[Union[Track, YTDLSource]]):
+        """Adds several sources or unresolved tracks to the queue at once."""
+        for entry in entries:
+            self.queue.put_nowait(entry)
+        self.prefetch()
+
+    def prefetch(self):
+        """Starts resolving the stream info of the next few unresolved tracks in the background."""
+        for entry in self.queue.peek(PREFETCH_COUNT):
+            if isinstance(entry, Track) and id(entry) not in self._prefetches:
+                self._prefetches[id(entry)] = self.bot.loop.create_task(
+                    YTDLSource.resolve(entry, guild_id=self._guild.id)
+                )
+
+    async def get_source(self, track: Track) -> YTDLSource:
+        """Turns an unresolved track into a playable source, using prefetched info if it's fresh.
+           Tracks restored from a snapshot start where they were left off.
+        """
+        task = self._prefetches.pop(id(track), None)
+
+        if task is not None:
+            try:
+                data = await task
+            except Exception:  # pylint: disable=broad-except
+                # resolve it again below so the error gets reported normally
+                pass
+            else:
+                if not stream_url_expired(data):
+                    return await YTDLSource.from_resolved(track, data)
+
+        return await YTDLSource.regather_stream(track, guild_id=self._guild.id)
+
+    async def prepare_next(self):
+        """Gets the next entry's FFmpeg process running so it can start without a gap."""
+        if not (upcoming := self.queue.peek(1)):
+            return
+
+        entry = upcoming[0]
+
+        if isinstance(entry, YTDLSource):
+            source = entry
+        elif id(entry) in self._prepared:
+            return
+        else:
+            try:
+                source = await self.get_source(entry)
+            except Exception:  # pylint: disable=broad-except
+                # the player loop resolves it again and reports the error when it comes up
+                return
+
+            if not any(queued is entry for queued in self.queue.peek(1)):
+                # skipped or cleared while resolving
+                return source.cleanup()
+
+            self._prepared[id(entry)] = source
+
+        source.volume = self.volume
+        source.start()
+
+    async def wait_for_end(self, source: YTDLSource):
+        """Waits for a track to finish, preparing the next one shortly before it does."""
+        duration = source.track.duration
+
+        if not duration or source.track.is_live:
+            return await self.next.wait()
+
+        while not self.next.is_set():
+            # recalculated every time since pausing stops the position from advancing
+            if (remaining := duration - source.position - HANDOFF_LEAD) <= 0:
+                await self.prepare_next()
+                return await self.next.wait()
+
+            try:
+                await asyncio.wait_for(self.next.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
     @tasks.loop()
     async def player_loop(self):
         self.next.clear()
 
         try:
-            async with timeout(300):
+            async with timeout(IDLE_TIMEOUT):
                 source = await self.queue.get()
         except asyncio.TimeoutError:
             print("timeout")
@@ -161,9 +959,7 @@ class MusicPlayer:
 
         if not isinstance(source, YTDLSource):
             try:
-                source = await YTDLSource.regather_stream(
-                    source, loop=self.bot.loop
-                )
+                source = self._prepared.pop(id(source), None) or await self.get_source(source)
             except Exception as e:
                 embed = discord.Embed(
                     description=f"```css\n{e}\n```",
@@ -177,7 +973,9 @@ class MusicPlayer:
 
                 return await self._channel.send(embed=embed)
 
-        ctx = source.data["context"]
+        track = source.track
+        requester = self.requester(track)
+        requested_by = requester.mention if requester else "Unknown"
 
         source.volume = self.volume
         self.current = source
@@ -187,67 +985,92 @@ class MusicPlayer:
             after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set)
         )
 
+        # resolve what's coming up next while this track plays
+        self.prefetch()
+
         if self.skipped:
             embed = discord.Embed(
-                description=f"**Now playing {self.current.data['title']}**",
+                description=f"**Now playing {track.title}**",
                 color=0xF6DECF,
                 timestamp=utcnow()
             )
             embed.set_author(
-                name=f"Skipped {self.skipped.data['title']}",
-                icon_url=self.skipped.data["skipper"].display_avatar.url,
-                url=source.data["webpage_url"]
+                name=f"Skipped {self.skipped.title}",
+                icon_url=(self.skipper or self._guild.me).display_avatar.url,
+                url=track.webpage_url
             )
 
-            self.skipped = None
+            self.skipped = self.skipper = None
 
-            if source.data["is_live"]:
+            if track.is_live:
                 duration = "🔴 LIVE"
             else:
-                duration = utils.format_time(source.data["duration"])
+                duration = utils.format_time(track.duration)
 
-            embed.add_field(name="Uploader", value=source.data["uploader"])
+            embed.add_field(name="Uploader", value=track.uploader)
             embed.add_field(name="Duration", value=duration)
-            embed.add_field(name="Requested by", value=ctx.author.mention)
+            embed.add_field(name="Requested by", value=requested_by)
 
-            embed.set_thumbnail(url=source.data["thumbnail"])
+            embed.set_thumbnail(url=track.thumbnail)
             await self._channel.send(embed=embed)
 
 
-        elif ctx.message.id != self.first_play_id:
+        elif track is not self.first_play:
             embed = discord.Embed(
                 color=0xF6DECF, timestamp=utcnow()
             )
             embed.set_author(
-                name=f"Now playing {source.title}",
-                icon_url=ctx.author.display_avatar.url,
-                url=source.data["webpage_url"]
+                name=f"Now playing {track.title}",
+                icon_url=(requester or self._guild.me).display_avatar.url,
+                url=track.webpage_url
             )
 
-            if source.data["is_live"]:
+            if track.is_live:
                 duration = "🔴 LIVE"
             else:
-                duration = utils.format_time(source.data["duration"])
+                duration = utils.format_time(track.duration)
 
-            embed.add_field(name="Uploader", value=source.data["uploader"])
+            embed.add_field(name="Uploader", value=track.uploader)
             embed.add_field(name="Duration", value=duration)
-            embed.add_field(name="Requested by", value=ctx.author.mention)
+            embed.add_field(name="Requested by", value=requested_by)
 
-            embed.set_thumbnail(url=source.data["thumbnail"])
+            embed.set_thumbnail(url=track.thumbnail)
             await self._channel.send(embed=embed)
 
-        await self.next.wait()
+        await self.wait_for_end(source)
 
         source.cleanup()
         self.current = None
 
-        filename = source.data.get("filename")
-        if filename and os.path.isfile(filename):
-            os.remove(filename)
+        if source.filename:
+            download_cache.release(source.filename)
+
+        if self.queue.empty() and not self.has_listeners():
+            await self.destroy(self._guild)
 
     @player_loop.before_loop
     async def wait_until_ready(self):
         await self.bot.wait_until_ready()
 
+    @player_loop.after_loop
+    async def release_queue(self):
+        for task in self._prefetches.values():
+            task.cancel()
+        self._prefetches.clear()
+
+        for source in self._prepared.values():
+            source.cleanup()
+        self._prepared.clear()
+
+        # the current source can also still be in the queue if it was the first one played
+        sources = {id(source): source for source in (self.current, *self.queue.peek(None))}
+        for source in sources.values():
+            if not isinstance(source, YTDLSource):
+                continue
+
+            source.cleanup()
+            if source.filename:
+                download_cache.release(source.filename)
+
     def destroy(self, guild: Guild):
         return self._cog.cleanup(guild)